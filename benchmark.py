@@ -0,0 +1,441 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import PySide6
+from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import QPointF
+from PySide6.QtGui import QPixmap, QImage, QPainter, QColor, QLinearGradient
+
+from paint_x import Canvas, AutosaveJournal
+
+
+def make_canvas(width=1280, height=800):
+    canvas = Canvas()
+    canvas.resize(width, height)
+    return canvas
+
+def render(canvas):
+    target = QPixmap(canvas.size())
+    start = time.perf_counter()
+    canvas.render(target)
+    return time.perf_counter() - start
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def frame_stats(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {
+        "frames": len(samples),
+        "frame_p50_ms": percentile(0.5),
+        "frame_p90_ms": percentile(0.9),
+        "frame_p99_ms": percentile(0.99),
+        "frame_max_ms": ordered[-1] * 1000,
+    }
+
+def stroke_trace(rng, events, speed=6.0):
+    # Smooth random walk with varying pressure, like a hand-drawn scribble
+    x, y, heading = 0.0, 0.0, 0.0
+    points = []
+    for i in range(events):
+        heading += rng.uniform(-0.3, 0.3)
+        step = speed * (0.5 + rng.random())
+        x += math.cos(heading) * step
+        y += math.sin(heading) * step
+        points.append((x, y, 0.3 + 0.7 * abs(math.sin(i * 0.02))))
+    return points
+
+def fill_canvas(canvas, width, height, spacing=40):
+    canvas.tool = "pen"
+    canvas.begin_stroke()
+    for y in range(0, height, spacing):
+        canvas.draw_line_between_points(QPointF(0, y), QPointF(width, y + spacing / 2))
+    canvas.end_stroke()
+
+def test_image(rng, width, height):
+    image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    gradient = QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QColor("#204080"))
+    gradient.setColorAt(1, QColor("#f0c040"))
+    painter.fillRect(image.rect(), gradient)
+    for _ in range(400):
+        painter.setPen(QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        painter.drawLine(rng.randrange(width), rng.randrange(height),
+                         rng.randrange(width), rng.randrange(height))
+    painter.end()
+    return image
+
+def bench_stroke(rng, scale, tool="pen", events_per_frame=16):
+    # Raw segments through draw_line_between_points, flushed once per frame
+    canvas = make_canvas()
+    canvas.tool = tool
+    trace = stroke_trace(rng, int(4000 * scale))
+    frames = []
+    start = time.perf_counter()
+    stroke = canvas.begin_stroke()
+    last = QPointF(*trace[0][:2])
+    for i, (x, y, _) in enumerate(trace[1:], 1):
+        point = QPointF(x, y)
+        canvas.draw_line_between_points(last, point)
+        last = point
+        if i % events_per_frame == 0:
+            frame_start = time.perf_counter()
+            stroke.flush()
+            frames.append(time.perf_counter() - frame_start)
+    canvas.end_stroke()
+    elapsed = time.perf_counter() - start
+    result = {"events": len(trace), "events_per_sec": len(trace) / elapsed,
+              "tiles_allocated": canvas.tiles_allocated}
+    result.update(frame_stats(frames))
+    return result
+
+def bench_input(rng, scale, rate_hz=1000, frame_ms=16, tool="pen"):
+    # Simulated high-rate pointer: raw events are buffered and fitted once per frame
+    canvas = make_canvas()
+    canvas.tool = tool
+    trace = stroke_trace(rng, int(4000 * scale), speed=1.0)
+    stroke = canvas.begin_stroke()
+    frames = []
+    next_frame = frame_ms
+    start = time.perf_counter()
+    for i, (x, y, pressure) in enumerate(trace):
+        timestamp = i * 1000 // rate_hz
+        stroke.add_point(QPointF(x, y), timestamp, pressure)
+        if timestamp >= next_frame:
+            frame_start = time.perf_counter()
+            stroke.fit()
+            stroke.flush()
+            frames.append(time.perf_counter() - frame_start)
+            next_frame += frame_ms
+    canvas.end_stroke()
+    elapsed = time.perf_counter() - start
+    result = {"events": len(trace), "events_per_sec": len(trace) / elapsed,
+              "curves": stroke.segments, "tiles_allocated": canvas.tiles_allocated}
+    result.update(frame_stats(frames))
+    return result
+
+def bench_brush(rng, scale, size=100, frame_events=16):
+    canvas = make_canvas()
+    canvas.tool = "brush"
+    canvas.brush_size = size
+    trace = stroke_trace(rng, int(2000 * scale), speed=4.0)
+    stroke = canvas.begin_stroke()
+    start = time.perf_counter()
+    for i, (x, y, pressure) in enumerate(trace):
+        stroke.add_point(QPointF(x, y), i, pressure)
+        if i % frame_events == 0:
+            stroke.fit()
+            stroke.flush()
+    canvas.end_stroke()
+    elapsed = time.perf_counter() - start
+    return {
+        "size": size,
+        "dabs": stroke.dabs,
+        "dabs_per_sec": stroke.dabs / elapsed,
+        "dab_textures": len(canvas.dabs.dabs),
+        "tiles_allocated": canvas.tiles_allocated,
+    }
+
+def bench_pan(rng, scale, zoom=1.0, step=64):
+    canvas = make_canvas()
+    canvas.zoom = zoom
+    fill_canvas(canvas, 6000, 4000)
+    allocated = canvas.tiles_allocated
+    frames = []
+    for _ in range(int(200 * scale)):
+        canvas.offset -= QPointF(step / canvas.zoom, step / 2 / canvas.zoom)
+        frames.append(render(canvas))
+    result = frame_stats(frames)
+    result["tiles_allocated"] = canvas.tiles_allocated - allocated
+    return result
+
+def bench_zoom(rng, scale, steps=40):
+    # Sweep min_zoom -> max_zoom -> min_zoom over the middle of a large drawing
+    canvas = make_canvas()
+    fill_canvas(canvas, 16000, 12000)
+    allocated = canvas.tiles_allocated
+    evictions = canvas.tiles.evictions
+    low, high = math.log(canvas.min_zoom), math.log(canvas.max_zoom)
+    zooms = [math.exp(low + (high - low) * i / steps) for i in range(steps + 1)]
+    zooms += zooms[::-1]
+    frames = []
+    cleanups = []
+    for _ in range(max(1, round(scale))):
+        for zoom in zooms:
+            canvas.zoom = zoom
+            canvas.offset = QPointF(canvas.width() / 2 / zoom - 8000,
+                                    canvas.height() / 2 / zoom - 6000)
+            start = time.perf_counter()
+            canvas.cleanup_unused_tiles()
+            cleanups.append(time.perf_counter() - start)
+            frames.append(render(canvas))
+    result = frame_stats(frames)
+    result["cleanup_p99_ms"] = frame_stats(cleanups)["frame_p99_ms"]
+    result["tiles_allocated"] = canvas.tiles_allocated - allocated
+    result["tiles_evicted"] = canvas.tiles.evictions - evictions
+    report = canvas.tile_memory_report()
+    for level, usage in report.items():
+        name = f"level{level}" if isinstance(level, int) else level
+        result[f"{name}_kb"] = usage["bytes"] // 1024
+    for form, usage in sorted(report[0]["forms"].items()):
+        result[f"{form}_tiles"] = usage["tiles"]
+    return result
+
+def bench_layers(rng, scale, layers=4):
+    canvas = make_canvas()
+    for index in range(layers):
+        if index:
+            layer = canvas.add_layer()
+            canvas.set_layer_opacity(layer, 0.8)
+        fill_canvas(canvas, 2400, 1600, spacing=60 + index * 7)
+    cold = render(canvas)
+    builds = canvas.composites.builds
+    frames = [render(canvas) for _ in range(int(100 * scale))]
+    result = {"layers": layers, "cold_frame_ms": cold * 1000,
+              "composite_builds": canvas.composites.builds - builds}
+    result.update(frame_stats(frames))
+    return result
+
+def bench_export(rng, scale):
+    canvas = make_canvas()
+    side = int(8000 * math.sqrt(scale))
+    fill_canvas(canvas, side, side, spacing=24)
+    with tempfile.TemporaryDirectory(prefix="paintx-bench-") as folder:
+        path = os.path.join(folder, "export.png")
+        start = time.perf_counter()
+        ok = canvas.save_image(path)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(path) if ok else 0
+    tiles = len(canvas.all_tile_keys())
+    return {"ok": ok, "tiles": tiles, "seconds": elapsed,
+            "tiles_per_sec": tiles / elapsed, "file_mb": size / (1024 * 1024)}
+
+def bench_autosave(rng, scale, events_per_frame=16, stroke_events=200):
+    # The same strokes drawn twice, the second time with a checkpoint after each
+    # stroke written by a worker while the next one is drawn
+    trace = stroke_trace(rng, int(8000 * scale))
+    with tempfile.TemporaryDirectory(prefix="paintx-bench-") as folder:
+        return run_autosave(trace, os.path.join(folder, "autosave.pxj"),
+                            events_per_frame, stroke_events)
+
+def run_autosave(trace, path, events_per_frame, stroke_events):
+    result = {}
+    for journal in (None, AutosaveJournal(path)):
+        canvas = make_canvas()
+        canvas.brush_size = 12
+        frames = []
+        snapshots = []
+        job = None
+        for first in range(0, len(trace) - 1, stroke_events):
+            stroke = canvas.begin_stroke()
+            points = trace[first:first + stroke_events + 1]
+            for i in range(1, len(points)):
+                canvas.draw_line_between_points(QPointF(*points[i - 1][:2]), QPointF(*points[i][:2]))
+                if i % events_per_frame == 0:
+                    frame_start = time.perf_counter()
+                    stroke.flush()
+                    frames.append(time.perf_counter() - frame_start)
+            canvas.end_stroke()
+            if journal is not None and (job is None or job.isFinished()):
+                start = time.perf_counter()
+                job = canvas.autosave(journal)
+                snapshots.append(time.perf_counter() - start)
+                if job is not None:
+                    job.start()
+        if journal is None:
+            result["frame_p99_off_ms"] = frame_stats(frames)["frame_p99_ms"]
+            continue
+        if job is not None:
+            job.wait()
+        result.update(frame_stats(frames))
+        result.update({"checkpoints": journal.checkpoints, "compactions": journal.compactions,
+                       "snapshot_max_ms": max(snapshots) * 1000,
+                       "journal_mb": journal.file_bytes / (1024 * 1024)})
+        journal.delete()
+    return result
+
+def bench_import(rng, scale):
+    side = int(6000 * math.sqrt(scale))
+    image = test_image(rng, side, side)
+    megapixels = side * side / 1e6
+
+    canvas = make_canvas()
+    start = time.perf_counter()
+    canvas.load_image(image)
+    in_memory = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory(prefix="paintx-bench-") as folder:
+        path = os.path.join(folder, "import.png")
+        image.save(path)
+        del image
+        # The job's thread body runs inline so decoding and tile upload are timed together
+        start = time.perf_counter()
+        job = canvas.import_image(path)
+        job.run()
+        from_file = time.perf_counter() - start
+    return {"ok": job.ok, "megapixels": megapixels, "load_image_s": in_memory,
+            "import_file_s": from_file, "import_mpix_per_sec": megapixels / from_file,
+            "tiles": len(canvas.all_tile_keys())}
+
+STARTUP_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+from PySide6.QtWidgets import QApplication
+import paint_x
+imported = time.perf_counter()
+app = QApplication(sys.argv[:1])
+window = paint_x.PaintX()
+window.resize(1280, 800)
+built = time.perf_counter()
+window.show()
+window.grab()
+painted = time.perf_counter()
+window.toggle_dark_mode()
+window.grab()
+toggled = time.perf_counter()
+print(imported - start, built - imported, painted - built, toggled - painted)
+"""
+
+def bench_startup(rng, scale):
+    # Fresh interpreters, so imports and first-time stylesheet parsing are counted
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(max(3, int(5 * scale))):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=here,
+                                capture_output=True, text=True, check=True).stdout
+        wall = time.perf_counter() - start
+        runs.append([float(value) for value in output.split()] + [wall])
+    imports, build, paint, dark_mode, wall = (statistics.median(column) * 1000
+                                              for column in zip(*runs))
+    return {"runs": len(runs), "import_ms": imports, "build_ui_ms": build,
+            "first_paint_ms": paint, "to_first_paint_ms": imports + build + paint,
+            "dark_mode_toggle_ms": dark_mode, "process_wall_ms": wall}
+
+BENCHMARKS = {
+    "stroke": bench_stroke,
+    "input_1khz": bench_input,
+    "brush_100px": bench_brush,
+    "brush_12px": lambda rng, scale: bench_brush(rng, scale, size=12),
+    "pan": bench_pan,
+    "pan_zoom_25": lambda rng, scale: bench_pan(rng, scale, zoom=0.25),
+    "zoom_sweep": bench_zoom,
+    "layers": bench_layers,
+    "export": bench_export,
+    "import": bench_import,
+    "autosave": bench_autosave,
+    "startup": bench_startup,
+}
+
+def report(name, result):
+    values = ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                       for key, value in result.items())
+    print(f"{name:<16} {values}")
+
+def compare(baseline, results, args):
+    meta = baseline["meta"]
+    print(f"\nchange against {meta['time']}:")
+    if (meta["seed"], meta["scale"]) != (args.seed, args.scale):
+        print(f"warning: baseline ran with seed={meta['seed']} scale={meta['scale']}")
+    for name, result in results.items():
+        old = baseline["results"].get(name, {})
+        changes = []
+        for key, value in result.items():
+            before = old.get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if isinstance(before, (int, float)) and before:
+                changes.append(f"{key} {(value - before) / before * 100:+.1f}%")
+        if changes:
+            print(f"{name:<16} {', '.join(changes)}")
+
+def run_isolated(name, args):
+    # One process per benchmark, so peak RSS is that benchmark's alone rather
+    # than the high-water mark of everything that ran before it
+    command = [sys.executable, os.path.abspath(__file__), "--child", name,
+               "--scale", str(args.scale), "--seed", str(args.seed)]
+    done = subprocess.run(command, capture_output=True, text=True)
+    if done.returncode != 0:
+        print(f"{name:<16} failed", file=sys.stderr)
+        sys.stderr.write(done.stderr)
+        return None
+    return json.loads(done.stdout.splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Paint X canvas benchmarks")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), metavar="NAME",
+                        help="run a subset: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply workload sizes, e.g. 0.25 for a quick run")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", metavar="PATH", help="save results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="JSON from an earlier run")
+    parser.add_argument("--child", choices=list(BENCHMARKS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        if QApplication.instance() is None:
+            QApplication(sys.argv[:1])
+        # Seeded per benchmark so a subset replays the same traces as a full run
+        result = BENCHMARKS[args.child](random.Random(f"{args.seed}:{args.child}"), args.scale)
+        result["peak_rss_mb"] = peak_rss_mb()
+        print(json.dumps(result))
+        return
+
+    results = {}
+    for name in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        result = run_isolated(name, args)
+        if result is not None:
+            results[name] = result
+            report(name, result)
+
+    if args.json:
+        data = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pyside": PySide6.__version__,
+                "platform": platform.platform(),
+                "seed": args.seed,
+                "scale": args.scale,
+            },
+            "results": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), results, args)
+
+if __name__ == "__main__":
+    main()
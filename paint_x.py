@@ -1,103 +1,3130 @@
+import os
 import sys
 import time
 import math
+import json
+import zlib
+import struct
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                                QHBoxLayout, QLabel, QPushButton, QColorDialog,
                                QSpinBox, QFileDialog, QSlider, QFrame, QScrollArea,
-                               QInputDialog, QFontDialog)
-from PySide6.QtCore import Qt, QPoint, QSize, QRect, QTimer, QPointF, QRectF
-from PySide6.QtGui import (QPainter, QPen, QColor, QPixmap, QPainterPath,
-                          QImage, QIcon, QLinearGradient, QBrush, QPalette, QTransform)
+                               QInputDialog, QFontDialog, QProgressDialog, QComboBox,
+                               QMessageBox)
+from PySide6.QtCore import (Qt, QPoint, QSize, QSizeF, QRect, QTimer, QPointF, QRectF,
+                            QThread, QSemaphore, QLockFile, Signal)
+from PySide6.QtGui import (QGuiApplication, QPainter, QPen, QColor, QPixmap, QPainterPath,
+                          QImage, QIcon, QShortcut, QKeySequence, QLinearGradient, QBrush, QPalette, QTransform,
+                          QImageReader, QImageIOHandler, QFont, QFontMetricsF, QStaticText,
+                          QRadialGradient, QInputDevice)
 
-class ToolButton(QPushButton):
-    def __init__(self, text, icon_name=None, tooltip=None, dark_mode=False):
+PRIMARY_COLORS = [
+    "#000000", "#ffffff", "#808080",
+    "#ff0000", "#ff8000", "#ffff00",
+    "#00ff00", "#00ffff", "#0000ff",
+    "#ff00ff", "#800000", "#008000"
+]
+
+THEMES = {
+    False: {"bg": "#f8f9fa", "text": "#212529", "border": "#dee2e6",
+            "hover": "#e9ecef", "handle": "#0d6efd"},
+    True: {"bg": "#2b2b2b", "text": "#ffffff", "border": "#555555",
+           "hover": "#3b3b3b", "handle": "#ffffff"},
+}
+
+STYLESHEET = """
+    QMainWindow, QFrame {{
+        background-color: {bg};
+    }}
+    QLabel {{
+        color: {text};
+        font-size: 11px;
+        padding: 0px;
+        margin: 0px;
+    }}
+    QLabel[role="setting"] {{
+        font-size: 12px;
+    }}
+    QLabel#sizePreview {{
+        background-color: white;
+        border: 1px solid #dee2e6;
+        border-radius: 4px;
+    }}
+    QSlider {{
+        margin: 0px;
+        padding: 0px;
+    }}
+    QSlider::groove:horizontal {{
+        border: 1px solid {border};
+        height: 3px;
+        background: {border};
+        margin: 0px;
+        border-radius: 1px;
+    }}
+    QSlider::handle:horizontal {{
+        background: {handle};
+        border: none;
+        width: 10px;
+        margin: -4px 0;
+        border-radius: 5px;
+    }}
+    QPushButton {{
+        background-color: {bg};
+        color: {text};
+        border: 1px solid {border};
+        border-radius: 2px;
+        padding: 1px;
+    }}
+    QPushButton:hover {{
+        background-color: {hover};
+    }}
+    QPushButton[role="file"] {{
+        font-size: 16px;
+        border: 1px solid {border};
+        border-radius: 4px;
+    }}
+    ToolButton {{
+        border: none;
+        border-radius: 4px;
+        font-size: 18px;
+        padding: 5px;
+    }}
+    ToolButton:checked {{
+        background-color: #0d6efd;
+        color: white;
+    }}
+    ColorButton, QPushButton#customColor {{
+        border: 1px solid {border};
+        border-radius: 4px;
+        margin: 2px;
+    }}
+    ColorButton:hover, ColorButton:checked, QPushButton#customColor:hover {{
+        border: 2px solid #0d6efd;
+    }}
+    QPushButton#customColor {{
+        background-color: white;
+    }}
+    QScrollArea {{
+        border: none;
+    }}
+    QFrame[frameShape="5"] {{  /* Vertical line */
+        background-color: {border};
+        max-width: 1px;
+        margin: 2px;
+    }}
+"""
+
+SWATCH_STYLE = """
+    ColorButton[swatch="{color}"] {{
+        background-color: {color};
+    }}
+"""
+
+STYLESHEETS = {}
+ICONS = {}
+
+AUTOSAVE_DIR = os.path.join(os.path.expanduser("~"), ".paintx")
+AUTOSAVE_INTERVAL = 5000
+
+def app_stylesheet(dark_mode):
+    # One sheet per theme for the whole window, formatted once; per-widget
+    # sheets would each be parsed and polished separately
+    if dark_mode not in STYLESHEETS:
+        swatches = "".join(SWATCH_STYLE.format(color=color) for color in PRIMARY_COLORS)
+        STYLESHEETS[dark_mode] = STYLESHEET.format(**THEMES[dark_mode]) + swatches
+    return STYLESHEETS[dark_mode]
+
+def load_icon(path):
+    if path not in ICONS:
+        ICONS[path] = QIcon(path) if os.path.exists(path) else None
+    return ICONS[path]
+
+class IconButton(QPushButton):
+    def __init__(self, text, icon_name=None, icon_size=None):
         super().__init__(text)
+        self.icon_name = icon_name
+        self.icon_size = icon_size
+        
+    def showEvent(self, event):
+        # Icons are read from disk when the button is first shown, not at construction
+        if self.icon_name:
+            icon = load_icon(self.icon_name)
+            if icon is not None:
+                self.setIcon(icon)
+                if self.icon_size:
+                    self.setIconSize(QSize(self.icon_size, self.icon_size))
+            self.icon_name = None
+        super().showEvent(event)
+
+class ToolButton(IconButton):
+    def __init__(self, text, icon_name=None, tooltip=None):
+        super().__init__(text, icon_name, 24)
         self.setFixedSize(40, 40)
-        self.dark_mode = dark_mode
+        self.setCheckable(True)
+        if tooltip:
+            self.setToolTip(tooltip)
+
+class ColorButton(QPushButton):
+    def __init__(self, color):
+        super().__init__()
+        self.setFixedSize(24, 24)
+        self.color = color
+        self.setProperty("swatch", color)
+
+class CanvasTile:
+    # Tiles keep one of these forms and only expand to a pixmap when drawn or painted:
+    #   "pixmap"  - a full (size + 2)^2 ARGB pixmap
+    #   "solid"   - one premultiplied ARGB32 value; new tiles start solid transparent
+    #   "palette" - run-length encoded indices into a palette of up to 256 colours
+    #   "zlib"    - deflated ARGB32 bytes, for cold tiles that fit neither
+    OVERHEAD = 256
+
+    def __init__(self, size=512, pixmap=None, form="solid", data=0):
+        self.form, self.data = ("pixmap", pixmap) if pixmap is not None else (form, data)
+        self.size = size
+        self.key = None
+        self.cache = None
+        self.dirty = False
+        self.spilled = False
+        self.incompressible = False
+
+    @classmethod
+    def from_image(cls, size, image):
+        import pixel_ops
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        form = pixel_ops.compact_form(pixel_ops.image_array(image))
+        if form is None:
+            # Opaque tiles must keep their alpha channel, or the eraser clears to black
+            return cls(size, QPixmap.fromImage(image, Qt.NoOpaqueDetection))
+        return cls(size, form=form[0], data=form[1])
+
+    @property
+    def pixmap(self):
+        if self.form != "pixmap":
+            # Like from_image, keep the alpha channel of opaque solid and palette tiles
+            self.set_form("pixmap", QPixmap.fromImage(self.image(), Qt.NoOpaqueDetection))
+        return self.data
+
+    def image(self):
+        if self.form == "pixmap":
+            return self.data.toImage()
+        side = self.size + 2
+        if self.form == "solid":
+            image = QImage(side, side, QImage.Format_ARGB32_Premultiplied)
+            image.fill(self.data)
+            return image
+        if self.form == "zlib":
+            return TileStore.decode(self.data, side, side)
+        import pixel_ops
+        return pixel_ops.palette_image(*self.data, side, side)
+
+    def drawable(self):
+        # Pixmap or a transient image, for readers that should not expand the tile
+        return self.data if self.form == "pixmap" else self.image()
+
+    def frozen(self):
+        # Pixels that stay put while the tile keeps changing: a pixmap hands out an
+        # implicitly shared image that its next painter detaches, and the compact
+        # forms are replaced rather than modified
+        if self.form == "pixmap":
+            return self.data.toImage()
+        return CanvasTile(self.size, form=self.form, data=self.data)
+
+    def compact(self):
+        if self.form != "pixmap" or self.incompressible:
+            return
+        import pixel_ops
+        image = self.data.toImage().convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        form = pixel_ops.compact_form(pixel_ops.image_array(image))
+        if form is None:
+            data = TileStore.encode(image)[0]
+            if len(data) * 2 > self.nbytes():
+                # Not worth retrying on every cleanup until the pixels change
+                self.incompressible = True
+                return
+            form = ("zlib", data)
+        self.set_form(*form)
+
+    def set_form(self, form, data):
+        before = self.nbytes()
+        self.form, self.data = form, data
+        if self.cache is not None:
+            self.cache.resized(self, before)
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.spilled = False
+        self.incompressible = False
+
+    def nbytes(self):
+        if self.form == "pixmap":
+            return self.data.width() * self.data.height() * 4
+        if self.form == "solid":
+            return self.OVERHEAD
+        if self.form == "zlib":
+            return self.OVERHEAD + len(self.data)
+        return self.OVERHEAD + sum(part.nbytes for part in self.data)
+
+class TileStore:
+    def __init__(self):
+        # Append-only scratch file holding zlib-compressed ARGB32 tiles
+        self.file = tempfile.TemporaryFile(prefix="paintx-tiles-")
+        self.index = {}
+        self.file_bytes = 0
+        self.live_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.page_ins = 0
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    @staticmethod
+    def encode(source, level=1):
+        image = source.toImage() if isinstance(source, QPixmap) else source
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        return zlib.compress(bytes(image.constBits()), level), image.width(), image.height()
+
+    def spill(self, key, tile):
+        if tile.form == "zlib":
+            data, width, height = tile.data, tile.size + 2, tile.size + 2
+        else:
+            data, width, height = self.encode(tile.image())
+        self.discard(key)
+        self.file.seek(self.file_bytes)
+        self.file.write(data)
+        self.index[key] = (self.file_bytes, len(data), width, height, tile.dirty)
+        self.file_bytes += len(data)
+        self.live_bytes += len(data)
+        self.spills += 1
+        tile.spilled = True
+        if self.file_bytes > 4 * 1024 * 1024 and self.file_bytes > 2 * self.live_bytes:
+            self.compact()
+
+    def read_raw(self, key):
+        offset, length, width, height, _ = self.index[key]
+        self.file.seek(offset)
+        return self.file.read(length), width, height
+
+    @staticmethod
+    def decode(data, width, height):
+        data = zlib.decompress(data)
+        return QImage(data, width, height, width * 4, QImage.Format_ARGB32_Premultiplied).copy()
+
+    def read_image(self, key):
+        return self.decode(*self.read_raw(key))
+
+    def load(self, key, size):
+        tile = CanvasTile.from_image(size, self.read_image(key))
+        tile.dirty = self.index[key][4]
+        tile.spilled = True
+        self.page_ins += 1
+        return tile
+
+    def discard(self, key):
+        entry = self.index.pop(key, None)
+        if entry:
+            self.live_bytes -= entry[1]
+
+    def compact(self):
+        new_file = tempfile.TemporaryFile(prefix="paintx-tiles-")
+        new_index = {}
+        offset = 0
+        for key, (old_offset, length, width, height, dirty) in self.index.items():
+            self.file.seek(old_offset)
+            new_file.write(self.file.read(length))
+            new_index[key] = (offset, length, width, height, dirty)
+            offset += length
+        self.file.close()
+        self.file = new_file
+        self.index = new_index
+        self.file_bytes = offset
+        self.live_bytes = offset
+
+    def clear(self):
+        # A fresh file rather than truncating, so snapshots still reading the old
+        # one keep their tiles
+        self.file.close()
+        self.file = tempfile.TemporaryFile(prefix="paintx-tiles-")
+        self.index.clear()
+        self.file_bytes = 0
+        self.live_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "spills": self.spills,
+            "page_ins": self.page_ins,
+            "stored_tiles": len(self.index),
+            "file_bytes": self.file_bytes,
+            "live_bytes": self.live_bytes,
+        }
+
+class ProjectFile:
+    MAGIC = b"PXPROJ1\n"
+    TRAILER = b"PXINDEX\n"
+    TRAILER_SIZE = 24
+
+    def __init__(self, path):
+        # Tiles are appended as compressed blobs; a trailer at the end points at the
+        # JSON index, so a save only appends changed tiles and a new index
+        self.path = path
+        self.tiles = {}
+        self.texts = []
+        self.layers = []
+        self.file_bytes = 0
+        self.live_bytes = 0
+        self.handle = None
+
+    @classmethod
+    def open(cls, path):
+        project = cls(path)
+        project.handle = open(path, "rb")
+        project.read_index()
+        return project
+
+    def read_index(self):
+        self.handle.seek(0, os.SEEK_END)
+        end = self.handle.tell()
+        self.handle.seek(0)
+        if self.handle.read(len(self.MAGIC)) != self.MAGIC or end < self.TRAILER_SIZE:
+            raise ValueError(f"{self.path} is not a Paint X project")
+            
+        index = self.index_at(end)
+        if index is None:
+            # A save cut short leaves a torn tail after the previous trailer, which
+            # still describes the project as it was last saved
+            end = self.find_trailer(end)
+            if end is None:
+                raise ValueError(f"{self.path} has no project index")
+            index = self.index_at(end)
+        if index.get("version") != 1:
+            raise ValueError(f"{self.path} uses an unsupported project version")
+        self.tiles = {(layer, tx, ty): (offset, length, width, height)
+                      for layer, tx, ty, offset, length, width, height in index["tiles"]}
+        self.texts = index["texts"]
+        self.layers = index["layers"]
+        self.file_bytes = end
+        self.live_bytes = sum(entry[1] for entry in self.tiles.values())
+
+    def index_at(self, end):
+        if end < len(self.MAGIC) + self.TRAILER_SIZE:
+            return None
+        self.handle.seek(end - self.TRAILER_SIZE)
+        offset, length, marker = struct.unpack(">QQ8s", self.handle.read(self.TRAILER_SIZE))
+        if marker != self.TRAILER or offset + length > end - self.TRAILER_SIZE:
+            return None
+        self.handle.seek(offset)
+        try:
+            return json.loads(zlib.decompress(self.handle.read(length)))
+        except (zlib.error, ValueError):
+            return None
+
+    def find_trailer(self, end, chunk=1024 * 1024):
+        # Scans backwards for the last trailer whose index reads back intact
+        position = end
+        while position > len(self.MAGIC):
+            start = max(len(self.MAGIC), position - chunk)
+            self.handle.seek(start)
+            data = self.handle.read(position - start + len(self.TRAILER))
+            found = data.rfind(self.TRAILER)
+            while found >= 0:
+                trailer_end = start + found + len(self.TRAILER)
+                if trailer_end <= end and self.index_at(trailer_end) is not None:
+                    return trailer_end
+                found = data.rfind(self.TRAILER, 0, found)
+            position = start
+        return None
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def keys(self):
+        return self.tiles.keys()
+
+    def read_raw(self, key):
+        offset, length, width, height = self.tiles[key]
+        self.handle.seek(offset)
+        return self.handle.read(length), width, height
+
+    def load(self, key, size):
+        return CanvasTile.from_image(size, TileStore.decode(*self.read_raw(key)))
+
+    def write(self, changed, texts, layers, keep=frozenset()):
+        # changed maps (layer, tx, ty) keys to (data, width, height); keep is the
+        # set of keys carried over unchanged
+        if self.handle is None:
+            full = True
+        else:
+            garbage = self.file_bytes - self.live_bytes
+            full = garbage > 8 * 1024 * 1024 and garbage > self.live_bytes
+            
+        if full:
+            carried = {key: self.read_raw(key) for key in keep if key in self.tiles}
+            carried.update(changed)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as handle:
+                handle.write(self.MAGIC)
+                tiles = self.append_tiles(handle, carried, {})
+                self.append_index(handle, tiles, texts, layers)
+                handle.flush()
+                os.fsync(handle.fileno())
+            if self.handle is not None:
+                self.handle.close()
+            os.replace(temp_path, self.path)
+        else:
+            # The previous trailer is left where it is, so a crash before the new
+            # one is on disk still opens as the last save
+            with open(self.path, "r+b") as handle:
+                handle.seek(self.file_bytes)
+                tiles = {key: entry for key, entry in self.tiles.items() if key in keep}
+                tiles = self.append_tiles(handle, changed, tiles)
+                self.append_index(handle, tiles, texts, layers)
+                handle.flush()
+                os.fsync(handle.fileno())
+                handle.truncate()
+            self.handle.close()
+            
+        self.handle = open(self.path, "rb")
+        self.read_index()
+
+    def append_tiles(self, handle, blobs, tiles):
+        for key, (data, width, height) in blobs.items():
+            tiles[key] = (handle.tell(), len(data), width, height)
+            handle.write(data)
+        return tiles
+
+    def append_index(self, handle, tiles, texts, layers):
+        index = {
+            "version": 1,
+            "tiles": [[*key, *entry] for key, entry in tiles.items()],
+            "texts": texts,
+            "layers": layers,
+        }
+        data = zlib.compress(json.dumps(index).encode("utf-8"))
+        offset = handle.tell()
+        handle.write(data)
+        handle.write(struct.pack(">QQ8s", offset, len(data), self.TRAILER))
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+class AutosaveJournal:
+    MAGIC = b"PXJRNL1\n"
+    HEADER = struct.Struct(">III")
+
+    def __init__(self, path):
+        # Append-only crash journal. Each checkpoint is a record holding the tiles
+        # written since the previous one plus the layer and text state; replaying the
+        # records in order rebuilds the document. While a checkpoint runs only the
+        # autosave worker touches the journal.
+        self.path = path
+        self.handle = None
+        self.lock_file = None
+        self.tiles = {}
+        self.texts = []
+        self.layers = []
+        self.project = None
+        self.version = None
+        self.file_bytes = 0
+        self.live_bytes = 0
+        self.checkpoints = 0
+        self.compactions = 0
+
+    @classmethod
+    def open(cls, path):
+        journal = cls(path)
+        journal.handle = open(path, "rb")
+        journal.read_records()
+        return journal
+
+    @classmethod
+    def claim(cls, folder):
+        # A new journal for this instance, locked for as long as it runs
+        number = 0
+        while True:
+            journal = cls(os.path.join(folder, f"autosave-{os.getpid()}-{number}.pxj"))
+            if not os.path.exists(journal.path) and journal.lock():
+                return journal
+            number += 1
+
+    @classmethod
+    def orphans(cls, folder):
+        # Journals whose lock can be taken were left by an instance that is no
+        # longer running; they come back locked, newest first
+        if not os.path.isdir(folder):
+            return []
+        paths = [os.path.join(folder, name) for name in os.listdir(folder)
+                 if name.startswith("autosave") and name.endswith(".pxj")]
+        found = []
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            journal = cls(path)
+            if journal.lock():
+                found.append(journal)
+        return found
+
+    def lock(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.lock_file = QLockFile(self.path + ".lock")
+        # Only a dead owner makes a lock stale, however long the instance has run
+        self.lock_file.setStaleLockTime(0)
+        if not self.lock_file.tryLock(0):
+            self.lock_file = None
+            return False
+        return True
+
+    def unlock(self):
+        if self.lock_file is not None:
+            self.lock_file.unlock()
+            self.lock_file = None
+
+    def read_records(self):
+        handle = self.handle
+        handle.seek(0, os.SEEK_END)
+        end = handle.tell()
+        handle.seek(0)
+        if handle.read(len(self.MAGIC)) != self.MAGIC:
+            raise ValueError(f"{self.path} is not a Paint X journal")
+            
+        offset = len(self.MAGIC)
+        while offset + self.HEADER.size <= end:
+            header_length, blob_length, checksum = self.HEADER.unpack(handle.read(self.HEADER.size))
+            body = handle.read(header_length + blob_length)
+            if (header_length == 0 or len(body) < header_length + blob_length or
+                    zlib.crc32(body) != checksum):
+                # The checkpoint being written when the app died; the ones before it are whole
+                break
+            record = json.loads(zlib.decompress(body[:header_length]))
+            self.apply(record, offset + self.HEADER.size + header_length)
+            offset += self.HEADER.size + header_length + blob_length
+        self.file_bytes = offset
+
+    def apply(self, record, offset):
+        if record["reset"]:
+            self.tiles = {}
+            self.live_bytes = 0
+        for layer, tx, ty, length, width, height in record["tiles"]:
+            entry = self.tiles.pop((layer, tx, ty), None)
+            if entry:
+                self.live_bytes -= entry[1]
+            if length is not None:
+                self.tiles[(layer, tx, ty)] = (offset, length, width, height)
+                self.live_bytes += length
+                offset += length
+        self.texts = record["texts"]
+        self.layers = record["layers"]
+        self.project = record["project"]
+
+    def has_content(self):
+        return bool(self.tiles or self.texts or self.project)
+
+    def read_raw(self, key):
+        offset, length, width, height = self.tiles[key]
+        self.handle.seek(offset)
+        return self.handle.read(length), width, height
+
+    def checkpoint(self, snapshot, texts):
+        # Called from the autosave worker. The first checkpoint, and the first one
+        # after the document is cleared, opened or saved, starts a new file.
+        reset = self.version is None or snapshot.base_version > self.version
+        tiles = []
+        blobs = []
+        for key, version in snapshot.tile_versions.items():
+            if not reset and version <= self.version:
+                continue
+            if key in snapshot.entries:
+                data, width, height = snapshot.encoded(key, 1)
+                tiles.append([*key, len(data), width, height])
+                blobs.append(data)
+            elif not reset:
+                tiles.append([*key, None, None, None])
+        record = {"reset": reset, "project": snapshot.project, "texts": texts,
+                  "layers": [layer.to_dict() for layer in snapshot.layers], "tiles": tiles}
+        if reset:
+            self.rewrite(record, blobs)
+        else:
+            offset = self.write_record(self.handle, self.file_bytes, record, blobs)
+            self.apply(record, offset)
+            self.file_bytes = self.handle.tell()
+        self.version = snapshot.version
+        self.checkpoints += 1
+        
+        garbage = self.file_bytes - self.live_bytes
+        if garbage > 8 * 1024 * 1024 and garbage > self.live_bytes:
+            self.compact()
+
+    def write_record(self, handle, start, record, blobs):
+        # Blobs are streamed and the header written last, so a record cut short
+        # never passes its checksum
+        header = zlib.compress(json.dumps(record).encode("utf-8"))
+        handle.seek(start)
+        handle.write(self.HEADER.pack(0, 0, 0))
+        handle.write(header)
+        checksum = zlib.crc32(header)
+        length = 0
+        for data in blobs:
+            handle.write(data)
+            checksum = zlib.crc32(data, checksum)
+            length += len(data)
+        end = handle.tell()
+        handle.seek(start)
+        handle.write(self.HEADER.pack(len(header), length, checksum))
+        handle.seek(end)
+        handle.flush()
+        os.fsync(handle.fileno())
+        return start + self.HEADER.size + len(header)
+
+    def rewrite(self, record, blobs):
+        # A fresh file replaces the old one only once it is complete
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as handle:
+            handle.write(self.MAGIC)
+            offset = self.write_record(handle, len(self.MAGIC), record, blobs)
+            end = handle.tell()
+        self.close()
+        os.replace(temp_path, self.path)
+        self.handle = open(self.path, "r+b")
+        self.apply(record, offset)
+        self.file_bytes = end
+
+    def compact(self):
+        live = {layer["id"] for layer in self.layers}
+        keys = [key for key in self.tiles if key[0] in live]
+        tiles = [[*key, *self.tiles[key][1:]] for key in keys]
+        record = {"reset": True, "project": self.project, "texts": self.texts,
+                  "layers": self.layers, "tiles": tiles}
+        self.rewrite(record, (self.read_raw(key)[0] for key in keys))
+        self.compactions += 1
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        self.unlock()
+        self.tiles = {}
+        self.version = None
+        self.file_bytes = 0
+        self.live_bytes = 0
+
+class UndoRecord:
+    def __init__(self, tiles):
+        # tiles maps keys to compressed (data, width, height) before-images, or None
+        # for tiles that did not exist; spilled records hold file offsets instead
+        self.tiles = tiles
+        self.on_disk = False
+        self.nbytes = sum(len(blob[0]) for blob in tiles.values() if blob)
+
+class UndoHistory:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_records=200):
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory_bytes = 0
+        self.file = tempfile.TemporaryFile(prefix="paintx-undo-")
+        self.file_bytes = 0
+        self.live_bytes = 0
+        self.disk_records = 0
+
+    def push(self, tiles):
+        dropped, self.redo_stack = self.redo_stack, []
+        for record in dropped:
+            self.drop(record)
+        self.push_record(self.undo_stack, tiles)
+        while len(self.undo_stack) > self.max_records:
+            self.drop(self.undo_stack.pop(0))
+
+    def push_record(self, stack, tiles):
+        record = UndoRecord(tiles)
+        stack.append(record)
+        self.memory_bytes += record.nbytes
+        self.enforce_budget()
+
+    def pop_undo(self):
+        return self.load(self.undo_stack.pop()) if self.undo_stack else None
+
+    def pop_redo(self):
+        return self.load(self.redo_stack.pop()) if self.redo_stack else None
+
+    def push_undo(self, tiles):
+        self.push_record(self.undo_stack, tiles)
+
+    def push_redo(self, tiles):
+        self.push_record(self.redo_stack, tiles)
+
+    def enforce_budget(self):
+        # Records furthest from the current state go to disk first, from either
+        # stack, so the next undo and the next redo stay in memory
+        distances = ([(len(self.undo_stack) - i, record) for i, record in enumerate(self.undo_stack)] +
+                     [(len(self.redo_stack) - i, record) for i, record in enumerate(self.redo_stack)])
+        for _, record in sorted(distances, key=lambda item: -item[0]):
+            if self.memory_bytes <= self.max_bytes:
+                break
+            if not record.on_disk:
+                self.spill(record)
+
+    def spill(self, record):
+        self.file.seek(self.file_bytes)
+        tiles = {}
+        for key, blob in record.tiles.items():
+            if blob is None:
+                tiles[key] = None
+                continue
+            data, width, height = blob
+            self.file.write(data)
+            tiles[key] = (self.file_bytes, len(data), width, height)
+            self.file_bytes += len(data)
+        record.tiles = tiles
+        record.on_disk = True
+        self.memory_bytes -= record.nbytes
+        self.live_bytes += record.nbytes
+        self.disk_records += 1
+
+    def load(self, record):
+        if not record.on_disk:
+            self.memory_bytes -= record.nbytes
+            return record.tiles
+            
+        tiles = {}
+        for key, entry in record.tiles.items():
+            if entry is None:
+                tiles[key] = None
+                continue
+            offset, length, width, height = entry
+            self.file.seek(offset)
+            tiles[key] = (self.file.read(length), width, height)
+        self.drop(record)
+        return tiles
+
+    def drop(self, record):
+        if record.on_disk:
+            self.disk_records -= 1
+            self.live_bytes -= record.nbytes
+            if self.disk_records == 0:
+                self.file.seek(0)
+                self.file.truncate()
+                self.file_bytes = 0
+            elif self.file_bytes > 4 * 1024 * 1024 and self.file_bytes > 2 * self.live_bytes:
+                self.compact()
+        else:
+            self.memory_bytes -= record.nbytes
+
+    def compact(self):
+        # Copies the records still on either stack into a new file
+        new_file = tempfile.TemporaryFile(prefix="paintx-undo-")
+        offset = 0
+        for record in self.undo_stack + self.redo_stack:
+            if not record.on_disk:
+                continue
+            tiles = {}
+            for key, entry in record.tiles.items():
+                if entry is None:
+                    tiles[key] = None
+                    continue
+                old_offset, length, width, height = entry
+                self.file.seek(old_offset)
+                new_file.write(self.file.read(length))
+                tiles[key] = (offset, length, width, height)
+                offset += length
+            record.tiles = tiles
+        self.file.close()
+        self.file = new_file
+        self.file_bytes = offset
+        self.live_bytes = offset
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.memory_bytes = 0
+        self.disk_records = 0
+        self.file.seek(0)
+        self.file.truncate()
+        self.file_bytes = 0
+        self.live_bytes = 0
+
+class TileCache:
+    def __init__(self, store):
+        # Resident tiles in least- to most-recently-used order, and the subset
+        # currently holding a full pixmap
+        self.tiles = OrderedDict()
+        self.expanded = OrderedDict()
+        self.store = store
+        self.resident_bytes = 0
+        self.evictions = 0
+        self.max_compact_spills = 64
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __getitem__(self, key):
+        return self.tiles[key]
+
+    def keys(self):
+        return self.tiles.keys()
+
+    def values(self):
+        return self.tiles.values()
+
+    def items(self):
+        return self.tiles.items()
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            if key in self.expanded:
+                self.expanded.move_to_end(key)
+        return tile
+
+    def add(self, key, tile):
+        self.tiles[key] = tile
+        tile.key, tile.cache = key, self
+        self.resident_bytes += tile.nbytes()
+        if tile.form == "pixmap":
+            self.expanded[key] = tile
+
+    def resized(self, tile, before):
+        self.resident_bytes += tile.nbytes() - before
+        if tile.form == "pixmap":
+            self.expanded[tile.key] = tile
+        else:
+            self.expanded.pop(tile.key, None)
+
+    def evict(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            return
+        tile.cache = None
+        self.expanded.pop(key, None)
+        self.resident_bytes -= tile.nbytes()
+        self.evictions += 1
+        # Written tiles go to the scratch file; untouched ones are just dropped
+        if tile.dirty and not tile.spilled:
+            self.store.spill(key, tile)
+
+    def discard(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is not None:
+            tile.cache = None
+            self.expanded.pop(key, None)
+            self.resident_bytes -= tile.nbytes()
+
+    def evict_to(self, max_bytes, protected=()):
+        # Cold tiles are first squeezed into compact forms in place, and the ones
+        # that stay full size leave memory; compact tiles go last, oldest first
+        for key, tile in list(self.expanded.items()):
+            if self.resident_bytes <= max_bytes:
+                return
+            if key not in protected:
+                tile.compact()
+                if tile.form == "pixmap":
+                    self.evict(key)
+        protected_bytes = sum(self.tiles[key].nbytes() for key in protected if key in self.tiles)
+        if protected_bytes >= max_bytes:
+            # The view alone is over budget, and dropping compact tiles frees next to nothing
+            return
+        # Each compact tile frees little but costs a spill, so only a batch leaves
+        # per call and later calls carry on
+        spills = 0
+        for _ in range(len(self.tiles)):
+            if self.resident_bytes <= max_bytes or spills >= self.max_compact_spills:
+                break
+            key = next(iter(self.tiles))
+            if key in protected:
+                self.tiles.move_to_end(key)
+            else:
+                self.evict(key)
+                spills += 1
+
+    def forms(self):
+        report = {}
+        for tile in self.tiles.values():
+            entry = report.setdefault(tile.form, {"tiles": 0, "bytes": 0})
+            entry["tiles"] += 1
+            entry["bytes"] += tile.nbytes()
+        return report
+
+    def clear(self):
+        for tile in self.tiles.values():
+            tile.cache = None
+        self.tiles.clear()
+        self.expanded.clear()
+        self.resident_bytes = 0
+
+class TilePyramid:
+    def __init__(self, canvas, max_level=5, max_bytes=96 * 1024 * 1024, frame_budget=0.012):
+        # Level n keeps one tile_size pixmap per 2^n x 2^n block of base tiles
+        self.canvas = canvas
+        self.max_level = max_level
+        self.max_bytes = max_bytes
+        self.frame_budget = frame_budget
+        self.levels = {level: OrderedDict() for level in range(1, max_level + 1)}
+        self.stale = set()
+        self.occupied = set()
+        self.bytes = 0
+        self.builds = 0
+
+    def level_for_zoom(self, zoom):
+        if zoom >= 0.5:
+            return 0
+        return min(self.max_level, int(math.log2(1 / zoom)))
+
+    def invalidate(self, key):
+        tx, ty = key
+        for level in range(1, self.max_level + 1):
+            level_key = (level, tx >> level, ty >> level)
+            self.stale.add(level_key)
+            self.occupied.add(level_key)
+
+    def invalidate_all(self):
+        self.stale = set(self.occupied)
+
+    def keys_for_rect(self, level, rect):
+        span = self.canvas.tile_size << level
+        min_x = int(rect.left() // span)
+        max_x = int(rect.right() // span)
+        min_y = int(rect.top() // span)
+        max_y = int(rect.bottom() // span)
+        return [(x, y) for x in range(min_x, max_x + 1)
+                       for y in range(min_y, max_y + 1)]
+
+    def get(self, level, x, y):
+        key = (level, x, y)
+        if key not in self.occupied:
+            return None
+            
+        cache = self.levels[level]
+        pixmap = cache.get((x, y))
+        if pixmap is not None and key not in self.stale:
+            cache.move_to_end((x, y))
+            return pixmap
+            
+        if pixmap is not None:
+            self.bytes -= pixmap.width() * pixmap.height() * 4
+        pixmap = self.build(level, x, y)
+        self.stale.discard(key)
+        cache[(x, y)] = pixmap
+        cache.move_to_end((x, y))
+        self.bytes += pixmap.width() * pixmap.height() * 4
+        self.evict()
+        return pixmap
+
+    def is_fresh(self, level, x, y):
+        return (x, y) in self.levels[level] and (level, x, y) not in self.stale
+
+    def get_within(self, level, x, y, deadline):
+        # get() spread over frames: builds bottom-up until `deadline` and returns
+        # None if the tile is not ready yet; finished children stay cached, so
+        # the next frame picks up where this one stopped
+        if (level, x, y) not in self.occupied:
+            return None
+        if not self.is_fresh(level, x, y):
+            if time.perf_counter() > deadline:
+                return None
+            if level > 1:
+                for dx in (0, 1):
+                    for dy in (0, 1):
+                        child = (x * 2 + dx, y * 2 + dy)
+                        if (level - 1, *child) not in self.occupied or \
+                                self.is_fresh(level - 1, *child):
+                            continue
+                        if self.get_within(level - 1, *child, deadline) is None:
+                            return None
+        return self.get(level, x, y)
+
+    def placeholder(self, level, x, y):
+        # Stand-in while a tile builds: its stale pixmap, else the matching part
+        # of the nearest cached coarser tile, however out of date; (pixmap, source)
+        pixmap = self.levels[level].get((x, y))
+        if pixmap is not None:
+            return pixmap, QRectF(pixmap.rect())
+        for up in range(1, self.max_level - level + 1):
+            pixmap = self.levels[level + up].get((x >> up, y >> up))
+            if pixmap is not None:
+                part = self.canvas.tile_size / (1 << up)
+                mask = (1 << up) - 1
+                return pixmap, QRectF((x & mask) * part, (y & mask) * part, part, part)
+        return None, None
+
+    def is_blank(self, level, x, y):
+        return (level, x, y) not in self.occupied
+
+    def evict(self):
+        # Fine levels are the largest and the cheapest to rebuild, so they go first
+        for level in range(1, self.max_level + 1):
+            cache = self.levels[level]
+            while self.bytes > self.max_bytes and cache:
+                _, old = cache.popitem(last=False)
+                self.bytes -= old.width() * old.height() * 4
+
+    def build(self, level, x, y):
+        size = self.canvas.tile_size
+        half = size / 2
+        pixmap = QPixmap(size, size)
+        pixmap.fill(Qt.transparent)
+        
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for dx in (0, 1):
+            for dy in (0, 1):
+                target = QRectF(dx * half, dy * half, half, half)
+                child = (x * 2 + dx, y * 2 + dy)
+                if level == 1:
+                    source = self.canvas.composite_tile(child, page_in=False)
+                    if isinstance(source, QImage):
+                        painter.drawImage(target, source, QRectF(1, 1, size, size))
+                    elif source is not None:
+                        painter.drawPixmap(target, source, QRectF(1, 1, size, size))
+                else:
+                    child_pixmap = self.get(level - 1, *child)
+                    if child_pixmap is not None:
+                        painter.drawPixmap(target, child_pixmap, QRectF(0, 0, size, size))
+        painter.end()
+        self.builds += 1
+        return pixmap
+
+    def memory_by_level(self):
+        report = {}
+        for level, cache in self.levels.items():
+            report[level] = {
+                "tiles": len(cache),
+                "bytes": sum(p.width() * p.height() * 4 for p in cache.values()),
+            }
+        return report
+
+    def clear(self):
+        for cache in self.levels.values():
+            cache.clear()
+        self.stale.clear()
+        self.occupied.clear()
+        self.bytes = 0
+
+BLEND_MODES = {
+    "normal": QPainter.CompositionMode_SourceOver,
+    "multiply": QPainter.CompositionMode_Multiply,
+    "screen": QPainter.CompositionMode_Screen,
+    "overlay": QPainter.CompositionMode_Overlay,
+    "darken": QPainter.CompositionMode_Darken,
+    "lighten": QPainter.CompositionMode_Lighten,
+    "add": QPainter.CompositionMode_Plus,
+}
+
+class Layer:
+    def __init__(self, layer_id, name, visible=True, opacity=1.0, blend_mode="normal"):
+        # Pixels live in the canvas tile cache/store/project under (id, tx, ty) keys
+        self.id = layer_id
+        self.name = name
+        self.visible = visible
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+
+    def is_passthrough(self):
+        return self.opacity >= 1.0 and self.blend_mode == "normal"
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "visible": self.visible,
+                "opacity": self.opacity, "blend_mode": self.blend_mode}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data["name"], data.get("visible", True),
+                   data.get("opacity", 1.0), data.get("blend_mode", "normal"))
+
+class CompositeCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        # Flattened layer stack per tile; None records tiles no visible layer covers
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.builds = 0
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def get(self, key):
+        self.tiles.move_to_end(key)
+        return self.tiles[key]
+
+    def put(self, key, pixmap):
+        self.invalidate(key)
+        self.tiles[key] = pixmap
+        self.builds += 1
+        if pixmap is not None:
+            self.bytes += pixmap.width() * pixmap.height() * 4
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            if old is not None:
+                self.bytes -= old.width() * old.height() * 4
+
+    def invalidate(self, key):
+        old = self.tiles.pop(key, None)
+        if old is not None:
+            self.bytes -= old.width() * old.height() * 4
+
+    def clear(self):
+        self.tiles.clear()
+        self.bytes = 0
+
+class FileView:
+    def __init__(self, handle):
+        # A private descriptor on an open file. Reads are positional, so they never
+        # move the owner's offset, and they still see the file the view was taken
+        # from after the owner compacts, clears or rewrites it
+        handle.flush()
+        self.fd = os.dup(handle.fileno())
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def __del__(self):
+        os.close(self.fd)
+
+class TileSnapshot:
+    def __init__(self, document, keys=None):
+        # A consistent view of the document for worker threads. Resident tiles are
+        # shared copy-on-write, so the GUI thread never waits on a reader and only
+        # tiles written after the snapshot get duplicated. Tiles on disk are only
+        # located here and read by the worker through its own FileView; the ranges
+        # it reads are never overwritten, as both files only grow until they are
+        # replaced by a new one.
+        self.version = document.version
+        self.base_version = document.base_version
+        self.project = document.project.path if document.project is not None else None
+        self.tile_size = document.tile_size
+        self.layers = [Layer.from_dict(layer.to_dict()) for layer in document.layers]
+        self.tile_versions = dict(document.tile_versions)
+        self.entries = {}
+        for key, tile in document.tiles.items():
+            if keys is None or key in keys:
+                self.entries[key] = tile.frozen()
+        store = document.tile_store
+        stored = [key for key in store.keys()
+                  if key not in self.entries and (keys is None or key in keys)]
+        if stored:
+            view = FileView(store.file)
+            for key in stored:
+                self.entries[key] = (view, *store.index[key][:4])
+        project = document.project
+        if project is not None:
+            live = {layer.id for layer in self.layers}
+            saved = [key for key in project.keys()
+                     if key[0] in live and key not in self.entries and (keys is None or key in keys)]
+            if saved:
+                view = FileView(project.handle)
+                for key in saved:
+                    self.entries[key] = (view, *project.tiles[key])
+        visible = {layer.id for layer in self.visible_layers()}
+        self.content = {key[1:] for key in self.entries if key[0] in visible}
+
+    def __contains__(self, key):
+        return key in self.content
+
+    def keys(self):
+        return self.content
+
+    def visible_layers(self):
+        return [layer for layer in self.layers if layer.visible and layer.opacity > 0]
+
+    def layer_image(self, key):
+        entry = self.entries.get(key)
+        if entry is None or isinstance(entry, QImage):
+            return entry
+        if isinstance(entry, CanvasTile):
+            return entry.image()
+        return TileStore.decode(*self.read(entry))
+
+    @staticmethod
+    def read(entry):
+        view, offset, length, width, height = entry
+        return view.read(offset, length), width, height
+
+    def encoded(self, key, level=6):
+        # Compressed (data, width, height) for one stored tile, reusing bytes that
+        # are already deflated
+        entry = self.entries[key]
+        if isinstance(entry, tuple):
+            return self.read(entry)
+        if isinstance(entry, CanvasTile) and entry.form == "zlib":
+            return entry.data, entry.size + 2, entry.size + 2
+        return TileStore.encode(self.layer_image(key), level)
+
+    def image(self, key):
+        # The visible layers at (tx, ty) flattened into one image
+        layers = self.visible_layers()
+        if len(layers) == 1 and layers[0].is_passthrough():
+            return self.layer_image((layers[0].id,) + tuple(key))
+        image = None
+        for layer in layers:
+            source = self.layer_image((layer.id,) + tuple(key))
+            if source is None:
+                continue
+            if image is None:
+                image = QImage(self.tile_size + 2, self.tile_size + 2,
+                               QImage.Format_ARGB32_Premultiplied)
+                image.fill(Qt.transparent)
+                painter = QPainter(image)
+            painter.setOpacity(layer.opacity)
+            painter.setCompositionMode(BLEND_MODES[layer.blend_mode])
+            painter.drawImage(0, 0, source)
+        if image is not None:
+            painter.end()
+        return image
+
+class ExportJob(QThread):
+    progress = Signal(int, int)
+    completed = Signal(bool, str)
+
+    def __init__(self, snapshot, tile_size, file_path, background=Qt.white):
+        super().__init__()
+        # snapshot is a TileSnapshot; layers are flattened here rather than on the GUI thread
+        self.snapshot = snapshot
+        self.tile_size = tile_size
+        self.file_path = file_path
+        self.background = QColor(background)
+        self.cancelled = False
+        self.ok = False
+        
+        keys = snapshot.keys()
+        self.min_tx = min(x for x, y in keys)
+        self.max_tx = max(x for x, y in keys)
+        self.min_ty = min(y for x, y in keys)
+        self.max_ty = max(y for x, y in keys)
+        self.width = (self.max_tx - self.min_tx + 1) * tile_size
+        self.height = (self.max_ty - self.min_ty + 1) * tile_size
+
+    def cancel(self):
+        self.cancelled = True
+
+    def compose_strip(self, ty):
+        strip = QImage(self.width, self.tile_size, QImage.Format_RGB888)
+        strip.fill(self.background)
+        painter = QPainter(strip)
+        source = QRect(1, 1, self.tile_size, self.tile_size)
+        for tx in range(self.min_tx, self.max_tx + 1):
+            if (tx, ty) in self.snapshot:
+                x = (tx - self.min_tx) * self.tile_size
+                painter.drawImage(QRect(x, 0, self.tile_size, self.tile_size),
+                                  self.snapshot.image((tx, ty)), source)
+        painter.end()
+        return strip
+
+    def run(self):
+        try:
+            if self.file_path.lower().endswith(".png"):
+                self.ok = self.write_png()
+            else:
+                self.ok = self.write_image()
+        except OSError:
+            self.ok = False
+        self.completed.emit(self.ok, self.file_path)
+
+    def write_png(self):
+        # Strips of one tile row are encoded as they are composed, so peak memory
+        # stays at one strip instead of the whole bitmap
+        def chunk(handle, tag, data):
+            handle.write(struct.pack(">I", len(data)))
+            handle.write(tag + data)
+            handle.write(struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+        
+        rows = self.max_ty - self.min_ty + 1
+        row_bytes = self.width * 3
+        # Written next to the target and moved into place once complete, so a
+        # cancelled or failed export leaves an existing file untouched
+        temp_path = self.file_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as handle:
+                handle.write(b"\x89PNG\r\n\x1a\n")
+                chunk(handle, b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
+                
+                compressor = zlib.compressobj(6)
+                for index, ty in enumerate(range(self.min_ty, self.max_ty + 1)):
+                    if self.cancelled:
+                        return False
+                    strip = self.compose_strip(ty)
+                    bits = strip.constBits()
+                    stride = strip.bytesPerLine()
+                    data = b"".join(b"\x00" + bytes(bits[y * stride:y * stride + row_bytes])
+                                    for y in range(self.tile_size))
+                    compressed = compressor.compress(data)
+                    if compressed:
+                        chunk(handle, b"IDAT", compressed)
+                    self.progress.emit(index + 1, rows)
+                
+                chunk(handle, b"IDAT", compressor.flush())
+                chunk(handle, b"IEND", b"")
+            os.replace(temp_path, self.file_path)
+            return True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def write_image(self):
+        # Formats without a row-streaming encoder are composed in full, still off the GUI thread
+        result = QImage(self.width, self.height, QImage.Format_RGB888)
+        rows = self.max_ty - self.min_ty + 1
+        painter = QPainter(result)
+        for index, ty in enumerate(range(self.min_ty, self.max_ty + 1)):
+            if self.cancelled:
+                break
+            y = (ty - self.min_ty) * self.tile_size
+            painter.drawImage(0, y, self.compose_strip(ty))
+            self.progress.emit(index + 1, rows)
+        painter.end()
+        
+        if self.cancelled:
+            return False
+        return result.save(self.file_path)
+
+def slice_tile_images(image, ty, tile_size, top=0, columns=None):
+    # Tiles carry a one pixel border shared with their neighbours
+    if columns is None:
+        columns = range((image.width() + tile_size - 1) // tile_size)
+    y = ty * tile_size - 1 - top
+    return [((tx, ty), image.copy(tx * tile_size - 1, y, tile_size + 2, tile_size + 2))
+            for tx in columns]
+
+class ImportJob(QThread):
+    tiles_ready = Signal(list)
+    progress = Signal(int, int)
+    completed = Signal(bool, str)
+
+    def __init__(self, file_path, tile_size, max_strips_in_flight=4, workers=4,
+                 max_band_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.file_path = file_path
+        self.tile_size = tile_size
+        self.workers = workers
+        self.max_band_bytes = max_band_bytes
+        self.band = None
+        self.band_top = 0
+        # Bounds how many decoded strips can wait for the GUI thread at once
+        self.strips_in_flight = QSemaphore(max_strips_in_flight)
+        self.cancelled = False
+        self.ok = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def strip_consumed(self):
+        self.strips_in_flight.release()
+
+    def read_strip(self, top, bottom, width, height, band_rows):
+        # A clipped read still decodes the file from the top, so each read covers
+        # a band of many strips and strips are cut out of it
+        if self.band is None or bottom > self.band_top + self.band.height():
+            reader = QImageReader(self.file_path)
+            band_bottom = min(height, top + band_rows)
+            if band_bottom < height or top > 0:
+                reader.setClipRect(QRect(0, top, width, band_bottom - top))
+            self.band = reader.read().convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            self.band_top = top
+            if self.band.isNull():
+                return self.band
+        return self.band.copy(0, top - self.band_top, width, bottom - top)
+
+    def run(self):
+        reader = QImageReader(self.file_path)
+        size = reader.size()
+        if not reader.canRead() or not size.isValid():
+            self.completed.emit(False, self.file_path)
+            return
+            
+        width, height = size.width(), size.height()
+        # Decoders that can clip are read in bands of whole strips, bounded by
+        # max_band_bytes; the rest are decoded in one go
+        if reader.supportsOption(QImageIOHandler.ClipRect):
+            strip_rows = self.max_band_bytes // (width * 4) // self.tile_size
+            band_rows = max(1, strip_rows) * self.tile_size + 2
+        else:
+            band_rows = height
+        
+        rows = (height + self.tile_size - 1) // self.tile_size
+        tiles_x = (width + self.tile_size - 1) // self.tile_size
+        chunk = max(1, tiles_x // self.workers)
+        with ThreadPoolExecutor(self.workers) as pool:
+            for ty in range(rows):
+                if self.cancelled:
+                    break
+                top = max(0, ty * self.tile_size - 1)
+                bottom = min(height, (ty + 1) * self.tile_size + 1)
+                strip = self.read_strip(top, bottom, width, height, band_rows)
+                if strip.isNull():
+                    break
+                    
+                columns = [range(start, min(start + chunk, tiles_x))
+                           for start in range(0, tiles_x, chunk)]
+                parts = pool.map(lambda part: slice_tile_images(strip, ty, self.tile_size,
+                                                                top, part), columns)
+                tiles = [tile for part in parts for tile in part]
+                
+                while not self.strips_in_flight.tryAcquire(1, 100):
+                    if self.cancelled:
+                        break
+                if self.cancelled:
+                    break
+                self.tiles_ready.emit(tiles)
+                self.progress.emit(ty + 1, rows)
+            else:
+                self.ok = True
+        self.band = None
+        self.completed.emit(self.ok, self.file_path)
+
+class AutosaveJob(QThread):
+    def __init__(self, journal, snapshot, texts):
+        super().__init__()
+        self.journal = journal
+        self.snapshot = snapshot
+        self.texts = texts
+        self.ok = False
+
+    def run(self):
+        try:
+            self.journal.checkpoint(self.snapshot, self.texts)
+            self.ok = True
+        except OSError:
+            # Start over with a full checkpoint rather than append to a damaged file
+            self.journal.version = None
+
+class DabCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.dabs = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def render(diameter, hardness, color):
+        size = diameter + 2
+        image = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        edge = QColor(color)
+        edge.setAlpha(0)
+        gradient = QRadialGradient(QPointF(size / 2, size / 2), diameter / 2)
+        gradient.setColorAt(0, color)
+        gradient.setColorAt(min(hardness, 0.99), color)
+        gradient.setColorAt(1, edge)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(gradient))
+        painter.drawEllipse(QPointF(size / 2, size / 2), diameter / 2, diameter / 2)
+        painter.end()
+        return image
+
+    def get(self, diameter, hardness, color):
+        key = (diameter, round(hardness, 2), color.rgba())
+        image = self.dabs.get(key)
+        if image is not None:
+            self.dabs.move_to_end(key)
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = self.render(diameter, hardness, color)
+        nbytes = image.sizeInBytes()
+        while self.bytes + nbytes > self.max_bytes and self.dabs:
+            _, old = self.dabs.popitem(last=False)
+            self.bytes -= old.sizeInBytes()
+        self.dabs[key] = image
+        self.bytes += nbytes
+        return image
+
+    def clear(self):
+        self.dabs.clear()
+        self.bytes = 0
+
+def cubic_point(start, c1, c2, end, t):
+    u = 1 - t
+    return (start * (u * u * u) + c1 * (3 * u * u * t) +
+            c2 * (3 * u * t * t) + end * (t * t * t))
+
+def point_segment_distance(point, start, end):
+    dx = end.x() - start.x()
+    dy = end.y() - start.y()
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length > 0:
+        t = ((point.x() - start.x()) * dx + (point.y() - start.y()) * dy) / length
+        t = min(1.0, max(0.0, t))
+    return math.hypot(point.x() - start.x() - t * dx, point.y() - start.y() - t * dy)
+
+class StrokeSession:
+    def __init__(self, canvas, max_open_painters=64):
+        self.canvas = canvas
+        self.tool = canvas.tool
+        self.layer = canvas.active_layer
+        self.eraser = canvas.tool == "eraser"
+        self.stamp = canvas.tool == "brush"
+        self.opacity = canvas.opacity
+        self.max_open_painters = max_open_painters
+        
+        self.pen = QPen()
+        if self.eraser:
+            self.pen.setWidthF(canvas.brush_size * 2 / canvas.zoom)
+        else:
+            self.pen.setWidthF(canvas.brush_size / canvas.zoom)
+            self.pen.setColor(canvas.brush_color)
+        self.pen.setCapStyle(Qt.RoundCap)
+        self.pen.setJoinStyle(Qt.RoundJoin)
+        self.radius = self.pen.widthF() / 2 + 1
+        
+        self.painters = OrderedDict()
+        self.pending = {}
+        
+        # The brush stamps cached dab images instead of stroking a path
+        self.diameter = canvas.brush_size / canvas.zoom
+        self.hardness = canvas.brush_hardness
+        self.color = QColor(canvas.brush_color)
+        self.spacing = canvas.brush_spacing
+        self.dab_distance = 0.0
+        self.pending_dabs = {}
+        self.dabs = 0
+        # Dabs merge into a per-tile stroke buffer at full strength, and each
+        # flush redraws the tile as its pre-stroke pixels plus the buffer at the
+        # brush opacity, so overlapping dabs never add up past that opacity
+        self.buffers = {}
+        
+        # Raw input buffered until the next frame; points before `fitted`
+        # have already been turned into curves
+        self.points = []
+        self.pressures = []
+        self.last_time = None
+        self.tail = None
+        self.fitted = 0
+        self.min_spacing = 2.0 / canvas.zoom
+        self.events = 0
+        self.segments = 0
+
+    def add_point(self, point, timestamp, pressure=1.0):
+        self.events += 1
+        if self.points:
+            last = self.points[-1]
+            if abs(point.x() - last.x()) + abs(point.y() - last.y()) < self.min_spacing:
+                self.tail = (QPointF(point), pressure)
+                return
+            # Several events stamped in the same millisecond collapse into the
+            # newest one, as long as no fitted curve depends on the old point yet
+            if timestamp == self.last_time and len(self.points) - 1 > self.fitted + 1:
+                self.points[-1] = QPointF(point)
+                self.pressures[-1] = pressure
+                return
+        elif self.stamp and self.dabs == 0:
+            self.stamp_dab(point, pressure)
+        self.points.append(QPointF(point))
+        self.pressures.append(pressure)
+        self.last_time = timestamp
+        self.tail = None
+
+    def fit(self, final=False):
+        # Catmull-Rom through the buffered points, emitted as cubic Beziers.
+        # The newest segment waits for the point after it unless the stroke ends.
+        points = self.points
+        pressures = self.pressures
+        if final and self.tail is not None:
+            points.append(self.tail[0])
+            pressures.append(self.tail[1])
+            self.tail = None
+        end = len(points) - 1 if final else len(points) - 2
+        dirty = QRectF()
+        for i in range(self.fitted, end):
+            p0 = points[max(i - 1, 0)]
+            p1 = points[i]
+            p2 = points[i + 1]
+            p3 = points[min(i + 2, len(points) - 1)]
+            c1 = p1 + (p2 - p0) / 6
+            c2 = p2 - (p3 - p1) / 6
+            if self.stamp:
+                dirty = dirty.united(self.add_dabs(p1, c1, c2, p2, pressures[i], pressures[i + 1]))
+            else:
+                dirty = dirty.united(self.add_curve(p1, c1, c2, p2))
+        if end > self.fitted:
+            self.fitted = end
+        if self.fitted > 1:
+            del points[:self.fitted - 1]
+            del pressures[:self.fitted - 1]
+            self.fitted = 1
+        if final:
+            points.clear()
+            pressures.clear()
+            self.fitted = 0
+        return dirty
+
+    def stamp_dab(self, point, pressure):
+        diameter = max(1, round(self.diameter * pressure))
+        image = self.canvas.dabs.get(diameter, self.hardness, self.color)
+        half = image.width() / 2
+        top_left = QPointF(point.x() - half, point.y() - half)
+        for key in self.canvas.tiles_for_rect(QRectF(top_left, QSizeF(image.size()))):
+            dabs = self.pending_dabs.get(key)
+            if dabs is None:
+                self.pending_dabs[key] = [(top_left, image)]
+            else:
+                dabs.append((top_left, image))
+        self.dabs += 1
+
+    def add_dabs(self, start, c1, c2, end, start_pressure, end_pressure):
+        # Walk the curve in short chords and drop a dab every `spacing` units,
+        # carrying the leftover distance into the next curve
+        hull = (math.hypot(c1.x() - start.x(), c1.y() - start.y()) +
+                math.hypot(c2.x() - c1.x(), c2.y() - c1.y()) +
+                math.hypot(end.x() - c2.x(), end.y() - c2.y()))
+        spacing = max(1.0, self.diameter * min(start_pressure, end_pressure) * self.spacing)
+        steps = max(1, math.ceil(hull / max(1.0, spacing / 2)))
+        prev = start
+        for i in range(1, steps + 1):
+            point = cubic_point(start, c1, c2, end, i / steps)
+            seg = math.hypot(point.x() - prev.x(), point.y() - prev.y())
+            travelled = 0.0
+            while self.dab_distance + seg - travelled >= spacing:
+                travelled += spacing - self.dab_distance
+                self.dab_distance = 0.0
+                f = travelled / seg
+                t = (i - 1 + f) / steps
+                self.stamp_dab(prev + (point - prev) * f,
+                               start_pressure + (end_pressure - start_pressure) * t)
+            self.dab_distance += seg - travelled
+            prev = point
+        self.segments += 1
+        radius = self.diameter / 2 + 2
+        return QRectF(start, end).normalized().united(
+            QRectF(c1, c2).normalized()).adjusted(-radius, -radius, radius, radius)
+
+    def add_curve(self, start, c1, c2, end):
+        # A cubic never strays further from its chord than 3/4 of the
+        # furthest control point, so test tiles against a widened chord
+        bulge = 0.75 * max(point_segment_distance(c1, start, end),
+                           point_segment_distance(c2, start, end))
+        radius = self.radius + bulge
+        for key in self.canvas.tiles_for_segment(start, end, radius):
+            path = self.pending_path(key, start)
+            path.cubicTo(c1, c2, end)
+        self.segments += 1
+        return QRectF(start, end).normalized().adjusted(-radius, -radius, radius, radius)
+
+    def add_segment(self, start, end):
+        for key in self.canvas.tiles_for_segment(start, end, self.radius):
+            self.pending_path(key, start).lineTo(end)
+        self.segments += 1
+        return QRectF(start, end).normalized().adjusted(
+            -self.radius, -self.radius, self.radius, self.radius)
+
+    def pending_path(self, key, start):
+        path = self.pending.get(key)
+        if path is None:
+            path = QPainterPath(start)
+            self.pending[key] = path
+        elif path.currentPosition() != start:
+            path.moveTo(start)
+        return path
+
+    def painter_for(self, key, tile):
+        painter = self.painters.get(key)
+        if painter is not None:
+            self.painters.move_to_end(key)
+            return painter
+            
+        if len(self.painters) >= self.max_open_painters:
+            _, oldest = self.painters.popitem(last=False)
+            oldest.end()
+        
+        painter = QPainter(tile.pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        if self.eraser:
+            painter.setCompositionMode(QPainter.CompositionMode_Clear)
+        else:
+            painter.setOpacity(self.opacity)
+        painter.setPen(self.pen)
+        painter.setBrush(Qt.NoBrush)
+        painter.translate(-(key[0] * self.canvas.tile_size - 1),
+                          -(key[1] * self.canvas.tile_size - 1))
+        self.painters[key] = painter
+        return painter
+
+    def flush(self):
+        while self.pending:
+            key, path = self.pending.popitem()
+            if self.eraser and not self.canvas.has_tile(key):
+                continue
+            self.canvas.record_tile_before(key)
+            tile = self.canvas.get_tile(*key)
+            self.painter_for(key, tile).drawPath(path)
+            self.canvas.mark_tile_dirty(key, tile)
+        if self.pending_dabs:
+            import pixel_ops
+        while self.pending_dabs:
+            key, dabs = self.pending_dabs.popitem()
+            self.canvas.record_tile_before(key)
+            tile = self.canvas.get_tile(*key)
+            pixels = self.stroke_buffer(key)
+            origin = QPointF(key[0] * self.canvas.tile_size - 1,
+                             key[1] * self.canvas.tile_size - 1)
+            for top_left, image in dabs:
+                pixel_ops.stamp_max(pixels, pixel_ops.image_array(image),
+                                    round(top_left.x() - origin.x()),
+                                    round(top_left.y() - origin.y()))
+            painter = self.painter_for(key, tile)
+            painter.save()
+            painter.setOpacity(1.0)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            base = self.canvas.edit_before.get(self.canvas.layer_key(key))
+            if base is None:
+                painter.fillRect(QRectF(origin, QSizeF(pixels.shape[1], pixels.shape[0])),
+                                 Qt.transparent)
+            else:
+                painter.drawImage(origin, base)
+            painter.restore()
+            painter.drawImage(origin, self.buffers[key][0])
+            self.canvas.mark_tile_dirty(key, tile)
+
+    def stroke_buffer(self, key):
+        entry = self.buffers.get(key)
+        if entry is None:
+            import pixel_ops
+            side = self.canvas.tile_size + 2
+            image = QImage(side, side, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            entry = (image, pixel_ops.image_array(image))
+            self.buffers[key] = entry
+        return entry[1]
+
+    def protected_keys(self):
+        return self.painters.keys() | self.pending.keys() | self.pending_dabs.keys()
+
+    def close(self):
+        self.fit(final=True)
+        self.flush()
+        for painter in self.painters.values():
+            painter.end()
+        self.painters.clear()
+        self.buffers.clear()
+
+class TextIndex:
+    def __init__(self, cell_size=256):
+        # Uniform grid over the transformed bounds of each item
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = {}
+        self.next_order = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(sorted(self.entries, key=lambda item: self.entries[item][0]))
+
+    def cells_for_rect(self, rect):
+        min_x = int(rect.left() // self.cell_size)
+        max_x = int(rect.right() // self.cell_size)
+        min_y = int(rect.top() // self.cell_size)
+        max_y = int(rect.bottom() // self.cell_size)
+        return [(x, y) for x in range(min_x, max_x + 1)
+                       for y in range(min_y, max_y + 1)]
+
+    def insert(self, item, rect, order=None):
+        if order is None:
+            order = self.next_order
+            self.next_order += 1
+        cells = self.cells_for_rect(rect)
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(item)
+        self.entries[item] = (order, cells)
+
+    def remove(self, item):
+        order, cells = self.entries.pop(item)
+        for cell in cells:
+            bucket = self.cells[cell]
+            bucket.discard(item)
+            if not bucket:
+                del self.cells[cell]
+        return order
+
+    def update(self, item, rect):
+        self.insert(item, rect, self.remove(item))
+
+    def query(self, rect):
+        found = set()
+        for cell in self.cells_for_rect(rect):
+            found |= self.cells.get(cell, set())
+        return sorted(found, key=lambda item: self.entries[item][0])
+
+    def item_at(self, point, contains):
+        cell = (int(point.x() // self.cell_size), int(point.y() // self.cell_size))
+        candidates = sorted(self.cells.get(cell, ()), key=lambda item: self.entries[item][0],
+                            reverse=True)
+        for item in candidates:
+            if contains(point, item):
+                return item
+        return None
+
+    def clear(self):
+        self.cells.clear()
+        self.entries.clear()
+
+class TextItem:
+    def __init__(self, text, pos, font, color):
+        self._text = text
+        self._pos = pos
+        self._font = font
+        self._scale = 1.0
+        self._rotation = 0
+        self._color = color
+        self.selected = False
+        self.dragging = False
+        self.drag_start = None
+        self.original_pos = None
+        self.show_controls = False
+        self.last_click_time = 0
+        
+        # Layout depends on text and font; corners also on pos, scale and rotation
+        self.version = 0
+        self._layout = None
+        self._corners = None
+
+    def invalidate(self, layout=True):
+        # version tracks appearance; moving an item only resets its corners
+        if layout:
+            self._layout = None
+        self._corners = None
+        self.version += 1
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self.invalidate()
+
+    @property
+    def font(self):
+        return self._font
+
+    @font.setter
+    def font(self, value):
+        self._font = value
+        self.invalidate()
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, value):
+        self._color = value
+        self.version += 1
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @pos.setter
+    def pos(self, value):
+        self._pos = value
+        self._corners = None
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, value):
+        self._scale = value
+        self.invalidate(layout=False)
+
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, value):
+        self._rotation = value
+        self.invalidate(layout=False)
+
+    def layout(self):
+        if self._layout is None:
+            metrics = QFontMetricsF(self._font)
+            text_rect = metrics.boundingRect(self._text)
+            static_text = QStaticText(self._text)
+            static_text.setTextFormat(Qt.PlainText)
+            static_text.setPerformanceHint(QStaticText.AggressiveCaching)
+            static_text.prepare(QTransform(), self._font)
+            # drawStaticText takes the top-left corner, drawText the baseline
+            origin = QPointF(-text_rect.width() / 2, text_rect.height() / 2 - metrics.ascent())
+            self._layout = (text_rect, static_text, origin)
+        return self._layout
+
+    def corners(self):
+        if self._corners is None:
+            text_rect = self.layout()[0]
+            width = text_rect.width() * self._scale
+            height = text_rect.height() * self._scale
+            
+            transform = QTransform()
+            transform.translate(self._pos.x(), self._pos.y())
+            transform.rotate(self._rotation)
+            
+            self._corners = [
+                transform.map(QPointF(-width/2, -height/2)),
+                transform.map(QPointF(width/2, -height/2)),
+                transform.map(QPointF(width/2, height/2)),
+                transform.map(QPointF(-width/2, height/2))
+            ]
+        return self._corners
+
+    def to_dict(self):
+        return {
+            "text": self.text,
+            "pos": [self.pos.x(), self.pos.y()],
+            "font": self.font.toString(),
+            "color": self.color.name(QColor.HexArgb),
+            "scale": self.scale,
+            "rotation": self.rotation,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        font = QFont()
+        font.fromString(data["font"])
+        item = cls(data["text"], QPointF(*data["pos"]), font, QColor(data["color"]))
+        item.scale = data["scale"]
+        item.rotation = data["rotation"]
+        return item
+
+class TextSpriteCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_sprite_pixels=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_sprite_pixels = max_sprite_pixels
+        self.sprites = OrderedDict()
+        self.bytes = 0
+        self.frame = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def zoom_bucket(zoom):
+        # Quarter-octave buckets: blits are never scaled by more than ~19%
+        bucket = round(math.log2(zoom) * 4)
+        return bucket, 2 ** (bucket / 4)
+
+    def transform_for(self, item, zoom):
+        transform = QTransform()
+        transform.scale(zoom, zoom)
+        transform.rotate(item.rotation)
+        transform.scale(item.scale, item.scale)
+        return transform
+
+    def sprite_rect(self, item, transform):
+        text_rect, static_text, origin = item.layout()
+        pad = text_rect.height() * 0.25
+        local_rect = QRectF(origin, static_text.size()).united(
+            QRectF(-text_rect.width() / 2, -text_rect.height() / 2,
+                   text_rect.width(), text_rect.height())).adjusted(-pad, -pad, pad, pad)
+        return transform.mapRect(local_rect).toAlignedRect()
+
+    def render(self, item, transform, sprite_rect):
+        _, static_text, origin = item.layout()
+        pixmap = QPixmap(sprite_rect.size())
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setRenderHint(QPainter.TextAntialiasing)
+        painter.translate(-sprite_rect.left(), -sprite_rect.top())
+        painter.setTransform(transform, True)
+        painter.setFont(item.font)
+        painter.setPen(QPen(item.color))
+        painter.drawStaticText(origin, static_text)
+        painter.end()
+        return pixmap
+
+    def make_room(self, nbytes):
+        # Never evict sprites drawn this frame or the last one: if the working set
+        # does not fit, caching more would only thrash
+        while self.bytes + nbytes > self.max_bytes and self.sprites:
+            oldest = next(iter(self.sprites.values()))
+            if oldest[2] >= self.frame - 1:
+                return False
+            _, (old, _, _) = self.sprites.popitem(last=False)
+            self.bytes -= old.width() * old.height() * 4
+        return self.bytes + nbytes <= self.max_bytes
+
+    def begin_frame(self):
+        self.frame += 1
+
+    def get(self, item, zoom):
+        bucket, bucket_zoom = self.zoom_bucket(zoom)
+        key = (item, item.version, bucket)
+        entry = self.sprites.get(key)
+        if entry is not None:
+            self.hits += 1
+            entry[2] = self.frame
+            self.sprites.move_to_end(key)
+            return entry, bucket_zoom
+            
+        self.misses += 1
+        transform = self.transform_for(item, bucket_zoom)
+        sprite_rect = self.sprite_rect(item, transform)
+        pixels = sprite_rect.width() * sprite_rect.height()
+        if pixels > self.max_sprite_pixels or not self.make_room(pixels * 4):
+            return None, bucket_zoom
+            
+        entry = [self.render(item, transform, sprite_rect), QPointF(sprite_rect.topLeft()), self.frame]
+        self.sprites[key] = entry
+        self.bytes += pixels * 4
+        return entry, bucket_zoom
+
+    def draw(self, painter, item, zoom, offset):
+        sprite, bucket_zoom = self.get(item, zoom)
+        if sprite is None:
+            return False
+        pixmap, top_left, _ = sprite
+        factor = zoom / bucket_zoom
+        anchor = (item.pos + offset) * zoom
+        target = QRectF(anchor + top_left * factor,
+                        QSizeF(pixmap.width() * factor, pixmap.height() * factor))
+        painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+        return True
+
+    def clear(self):
+        self.sprites.clear()
+        self.bytes = 0
+
+class FrameProfiler:
+    FIELDS = ["time", "frame_ms", "stroke_ms", "tiles_ms", "text_ms", "cleanup_ms",
+              "tiles_drawn", "text_items", "tiles_allocated", "tiles_evicted", "resident_kb"]
+
+    def __init__(self, document, max_frames=600):
+        # Rolling window of per-frame records; work done between frames (input,
+        # cleanup) is charged to the next frame
+        self.frames = deque(maxlen=max_frames)
+        self.timings = {}
+        self.last_allocated = document.tiles_allocated
+        self.last_evictions = document.tiles.evictions
+
+    def add_time(self, name, start, end=None):
+        end = time.perf_counter() if end is None else end
+        self.timings[name] = self.timings.get(name, 0.0) + end - start
+
+    def end_frame(self, document, frame_start, tiles_drawn, text_items):
+        allocated = document.tiles_allocated
+        evictions = document.tiles.evictions
+        record = {"time": round(time.time(), 3),
+                  "frame_ms": round((time.perf_counter() - frame_start) * 1000, 3)}
+        for name in ("stroke", "tiles", "text", "cleanup"):
+            record[name + "_ms"] = round(self.timings.get(name, 0.0) * 1000, 3)
+        record["tiles_drawn"] = tiles_drawn
+        record["text_items"] = text_items
+        record["tiles_allocated"] = allocated - self.last_allocated
+        record["tiles_evicted"] = evictions - self.last_evictions
+        record["resident_kb"] = document.tiles.resident_bytes // 1024
+        self.frames.append(record)
+        self.timings.clear()
+        self.last_allocated, self.last_evictions = allocated, evictions
+
+    def summary(self, frames=120):
+        recent = list(self.frames)[-frames:]
+        if not recent:
+            return None
+        times = sorted(record["frame_ms"] for record in recent)
+        elapsed = recent[-1]["time"] - recent[0]["time"]
+        return {
+            "last": recent[-1],
+            "frame_times": [record["frame_ms"] for record in recent],
+            "p50_ms": times[len(times) // 2],
+            "p95_ms": times[int(len(times) * 0.95)],
+            "max_ms": times[-1],
+            "fps": (len(recent) - 1) / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def dump(self, file_path):
+        if file_path.lower().endswith(".csv"):
+            import csv
+            with open(file_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, self.FIELDS)
+                writer.writeheader()
+                writer.writerows(self.frames)
+        else:
+            with open(file_path, "w", encoding="utf-8") as f:
+                json.dump({"frames": list(self.frames)}, f, indent=1)
+
+TOOLS = ("select", "pen", "brush", "rectangle", "circle", "line", "eraser", "fill", "text")
+
+class Document:
+    def __init__(self):
+        super().__init__()
+        self.init_document()
+        
+    def init_document(self):
+        self.tile_size = 256
+        self.tile_store = TileStore()
+        self.tiles = TileCache(self.tile_store)
+        self.project = None
+        self.pyramid = TilePyramid(self)
+        self.composites = CompositeCache()
+        self.layers = [Layer(0, "Background")]
+        self.active_layer = self.layers[0]
+        self.next_layer_id = 1
+        self.brush_size = 3
+        self.brush_hardness = 0.5
+        self.brush_spacing = 0.1
+        self.dabs = DabCache()
+        self.brush_color = QColor("#000000")
+        self.tool = "pen"
+        self.opacity = 1.0
+        self.zoom = 1.0
+        self.text_items = TextIndex(self.tile_size)
+        self.text_sprites = TextSpriteCache()
+        self.stroke = None
+        self.edit_before = None
+        self.history = UndoHistory()
+        self.profiler = None
+        # Bumped on every pixel or layer change; tile_versions holds the version of
+        # each stored tile's last write since base_version, when the document was
+        # last cleared, opened or saved, so snapshots can tell what changed since
+        self.version = 0
+        self.base_version = 0
+        self.tile_versions = {}
+        
+        self.max_tiles_in_memory = 500
+        self.tiles_allocated = 0
+        self.base_tile_limit = 500
+        
+    def document_changed(self):
+        # Views repaint here; a headless document has nothing to refresh
+        pass
+        
+    def layer_key(self, key, layer=None):
+        # Storage keys are (layer id, tx, ty); the public tile API defaults to
+        # the active layer
+        return ((layer or self.active_layer).id,) + tuple(key)
+
+    def get_tile(self, tx, ty, layer=None):
+        key = self.layer_key((tx, ty), layer)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tile_store.hits += 1
+            return tile
+            
+        self.tile_store.misses += 1
+        self.cleanup_unused_tiles()
+        
+        if key in self.tile_store:
+            tile = self.tile_store.load(key, self.tile_size)
+        elif self.project is not None and key in self.project:
+            tile = self.project.load(key, self.tile_size)
+        else:
+            tile = CanvasTile(self.tile_size)
+            self.tiles_allocated += 1
+        self.tiles.add(key, tile)
+        return tile
+
+    def peek_tile(self, tx, ty, layer=None):
+        # Read-only lookup: never allocates a blank tile for empty space
+        if self.has_tile((tx, ty), layer):
+            return self.get_tile(tx, ty, layer)
+        return None
+
+    def has_tile(self, key, layer=None):
+        return self.has_stored_tile(self.layer_key(key, layer))
+
+    def has_stored_tile(self, key):
+        return (key in self.tiles or key in self.tile_store or
+                (self.project is not None and key in self.project))
+
+    def mark_tile_dirty(self, key, tile, layer=None):
+        tile.mark_dirty()
+        self.tile_changed(key, layer)
+
+    def tile_changed(self, key, layer=None):
+        self.version += 1
+        self.tile_versions[self.layer_key(key, layer)] = self.version
+        self.composites.invalidate(key)
+        self.pyramid.invalidate(key)
+
+    def tile_memory_report(self):
+        report = {0: {"tiles": len(self.tiles), "bytes": self.tiles.resident_bytes,
+                      "forms": self.tiles.forms()}}
+        report.update(self.pyramid.memory_by_level())
+        report["composite"] = {"tiles": len(self.composites.tiles), "bytes": self.composites.bytes}
+        return report
+
+    def tile_memory(self, key, layer=None):
+        # Where one tile lives and what it costs: its in-memory form, or its
+        # compressed size in the scratch file or project
+        stored = self.layer_key(key, layer)
+        if stored in self.tiles:
+            tile = self.tiles[stored]
+            return {"form": tile.form, "bytes": tile.nbytes()}
+        if stored in self.tile_store:
+            return {"form": "scratch", "bytes": self.tile_store.index[stored][1]}
+        if self.project is not None and stored in self.project:
+            return {"form": "project", "bytes": self.project.tiles[stored][1]}
+        return None
+
+    def stored_keys(self):
+        keys = set(self.tiles.keys()) | set(self.tile_store.keys())
+        if self.project is not None:
+            # Removed layers linger in the project until the next save
+            live = {layer.id for layer in self.layers}
+            keys |= {key for key in self.project.keys() if key[0] in live}
+        return keys
+
+    def all_tile_keys(self, layer=None):
+        layer_id = (layer or self.active_layer).id
+        return {(tx, ty) for lid, tx, ty in self.stored_keys() if lid == layer_id}
+
+    def content_keys(self):
+        # Tiles covered by any layer
+        return {(tx, ty) for _, tx, ty in self.stored_keys()}
+
+    def get_tile_image(self, key, layer=None):
+        return self.get_stored_image(self.layer_key(key, layer))
+
+    def get_stored_image(self, key):
+        if key in self.tiles:
+            return self.tiles[key].image()
+        if key in self.tile_store:
+            return self.tile_store.read_image(key)
+        if self.project is not None and key in self.project:
+            return TileStore.decode(*self.project.read_raw(key))
+        return None
+        
+    def visible_layers(self):
+        return [layer for layer in self.layers if layer.visible and layer.opacity > 0]
+
+    def layer_tile_source(self, key, layer):
+        # Resident pixmap, or a decoded image that is not paged into the cache
+        stored = self.layer_key(key, layer)
+        if stored in self.tiles:
+            return self.tiles[stored].drawable()
+        if self.has_stored_tile(stored):
+            return self.get_stored_image(stored)
+        return None
+
+    def composite_tile(self, key, page_in=True):
+        layers = self.visible_layers()
+        if len(layers) == 1 and layers[0].is_passthrough():
+            # A lone plain layer is its own composite
+            if not page_in:
+                return self.layer_tile_source(key, layers[0])
+            tile = self.peek_tile(*key, layers[0])
+            return tile.pixmap if tile is not None else None
+        if key in self.composites:
+            return self.composites.get(key)
+            
+        pixmap = None
+        for layer in layers:
+            source = self.layer_tile_source(key, layer)
+            if source is None:
+                continue
+            if pixmap is None:
+                pixmap = QPixmap(self.tile_size + 2, self.tile_size + 2)
+                pixmap.fill(Qt.transparent)
+                painter = QPainter(pixmap)
+            painter.setOpacity(layer.opacity)
+            painter.setCompositionMode(BLEND_MODES[layer.blend_mode])
+            if isinstance(source, QImage):
+                painter.drawImage(0, 0, source)
+            else:
+                painter.drawPixmap(0, 0, source)
+        if pixmap is not None:
+            painter.end()
+        self.composites.put(key, pixmap)
+        return pixmap
+
+    def layer_by_id(self, layer_id):
+        for layer in self.layers:
+            if layer.id == layer_id:
+                return layer
+        return None
+
+    def layers_changed(self):
+        # Visibility, opacity, blend mode and order affect every composite
+        self.version += 1
+        self.composites.clear()
+        self.pyramid.invalidate_all()
+        self.document_changed()
+
+    def add_layer(self, name=None):
+        self.end_stroke()
+        layer = Layer(self.next_layer_id, name or f"Layer {self.next_layer_id}")
+        self.next_layer_id += 1
+        self.layers.insert(self.layers.index(self.active_layer) + 1, layer)
+        self.active_layer = layer
+        self.layers_changed()
+        return layer
+
+    def remove_layer(self, layer):
+        if len(self.layers) == 1:
+            return False
+        self.end_stroke()
+        for key in [key for key in self.tiles.keys() if key[0] == layer.id]:
+            self.tiles.discard(key)
+        for key in [key for key in self.tile_store.keys() if key[0] == layer.id]:
+            self.tile_store.discard(key)
+        index = self.layers.index(layer)
+        self.layers.remove(layer)
+        if self.active_layer is layer:
+            self.active_layer = self.layers[max(0, index - 1)]
+        # Undo records that touch the removed layer are skipped on restore
+        self.layers_changed()
+        return True
+
+    def move_layer(self, layer, index):
+        self.layers.remove(layer)
+        self.layers.insert(max(0, min(index, len(self.layers))), layer)
+        self.layers_changed()
+
+    def set_layer_visible(self, layer, visible):
+        layer.visible = visible
+        self.layers_changed()
+
+    def set_layer_opacity(self, layer, opacity):
+        layer.opacity = max(0.0, min(1.0, opacity))
+        self.layers_changed()
+
+    def set_layer_blend_mode(self, layer, blend_mode):
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f"unknown blend mode {blend_mode!r}")
+        layer.blend_mode = blend_mode
+        self.layers_changed()
+
+    def get_visible_tiles(self):
+        # Tiles a view is showing; a headless document has none
+        return []
+        
+    def point_to_tile(self, point):
+        tx = int(point.x() // self.tile_size)
+        ty = int(point.y() // self.tile_size)
+        local_x = point.x() - tx * self.tile_size
+        local_y = point.y() - ty * self.tile_size
+        return (tx, ty), QPointF(local_x, local_y)
+
+    def tiles_for_rect(self, rect):
+        # Tile pixmaps overlap their neighbours by one pixel on every side
+        min_tx = int((rect.left() - 1) // self.tile_size)
+        max_tx = int((rect.right() + 1) // self.tile_size)
+        min_ty = int((rect.top() - 1) // self.tile_size)
+        max_ty = int((rect.bottom() + 1) // self.tile_size)
+        
+        return [(tx, ty) for tx in range(min_tx, max_tx + 1)
+                        for ty in range(min_ty, max_ty + 1)]
+
+    def segment_hits_tile(self, start, end, radius, key):
+        tx, ty = key
+        left = tx * self.tile_size - 1 - radius
+        top = ty * self.tile_size - 1 - radius
+        right = (tx + 1) * self.tile_size + 1 + radius
+        bottom = (ty + 1) * self.tile_size + 1 + radius
+        
+        dx = end.x() - start.x()
+        dy = end.y() - start.y()
+        t0, t1 = 0.0, 1.0
+        for p, q in ((-dx, start.x() - left), (dx, right - start.x()),
+                     (-dy, start.y() - top), (dy, bottom - start.y())):
+            if p == 0:
+                if q < 0:
+                    return False
+                continue
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+        return True
+
+    def tiles_for_segment(self, start, end, radius):
+        bounds = QRectF(start, end).normalized().adjusted(-radius, -radius, radius, radius)
+        return [key for key in self.tiles_for_rect(bounds)
+                if self.segment_hits_tile(start, end, radius, key)]
+        
+    def begin_edit(self):
+        self.edit_before = {}
+
+    def record_tile_before(self, key, layer=None):
+        key = self.layer_key(key, layer)
+        if self.edit_before is None or key in self.edit_before:
+            return
+        self.edit_before[key] = self.get_stored_image(key) if self.has_stored_tile(key) else None
+
+    def end_edit(self):
+        if self.edit_before:
+            self.history.push({key: TileStore.encode(image) if image is not None else None
+                               for key, image in self.edit_before.items()})
+        self.edit_before = None
+
+    def capture_tiles(self, keys):
+        return {key: TileStore.encode(self.get_stored_image(key))
+                if self.has_stored_tile(key) else None for key in keys}
+
+    def restore_tiles(self, tiles):
+        for (layer_id, tx, ty), blob in tiles.items():
+            layer = self.layer_by_id(layer_id)
+            if layer is None:
+                continue
+            if blob is not None:
+                self.put_tile_image((tx, ty), TileStore.decode(*blob), layer)
+            else:
+                self.remove_tile((tx, ty), layer)
+        self.document_changed()
+
+    def remove_tile(self, key, layer=None):
+        stored = self.layer_key(key, layer)
+        if self.project is not None and stored in self.project:
+            # Project tiles cannot be dropped from the index, so blank them instead
+            image = QImage(self.tile_size + 2, self.tile_size + 2,
+                           QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            self.put_tile_image(key, image, layer)
+            return
+        self.tiles.discard(stored)
+        self.tile_store.discard(stored)
+        self.tile_changed(key, layer)
+
+    def undo(self):
+        self.end_stroke()
+        tiles = self.history.pop_undo()
+        if tiles is None:
+            return False
+        self.history.push_redo(self.capture_tiles(tiles.keys()))
+        self.restore_tiles(tiles)
+        return True
+
+    def redo(self):
+        self.end_stroke()
+        tiles = self.history.pop_redo()
+        if tiles is None:
+            return False
+        self.history.push_undo(self.capture_tiles(tiles.keys()))
+        self.restore_tiles(tiles)
+        return True
+
+    def begin_stroke(self):
+        self.end_stroke()
+        self.begin_edit()
+        self.stroke = StrokeSession(self)
+        return self.stroke
+
+    def end_stroke(self):
+        if self.stroke is not None:
+            self.stroke.close()
+            self.stroke = None
+            self.end_edit()
+
+    def draw_line_between_points(self, start, end):
+        started = time.perf_counter()
+        if self.stroke is not None:
+            self.stroke.add_segment(start, end)
+        else:
+            self.begin_stroke().add_segment(start, end)
+            self.end_stroke()
+        if self.profiler is not None:
+            self.profiler.add_time("stroke", started)
+
+    def shape_path(self, tool, start, end):
+        path = QPainterPath()
+        if tool == "rectangle":
+            path.addRect(QRectF(start, end).normalized())
+        elif tool == "circle":
+            path.addEllipse(QRectF(start, end).normalized())
+        elif tool == "line":
+            path.moveTo(start)
+            path.lineTo(end)
+        return path
+
+    def shape_pen(self):
+        pen = QPen(self.brush_color)
+        pen.setWidth(self.brush_size)
+        pen.setCapStyle(Qt.RoundCap)
+        pen.setJoinStyle(Qt.RoundJoin)
+        return pen
+
+    def tiles_for_path(self, path, radius):
+        # Only tiles the outline itself crosses, not the whole bounding box
+        keys = set()
+        for polygon in path.toSubpathPolygons():
+            for i in range(1, polygon.size()):
+                keys.update(self.tiles_for_segment(polygon.at(i - 1), polygon.at(i), radius))
+            if polygon.size() == 1:
+                point = polygon.at(0)
+                keys.update(self.tiles_for_segment(point, point, radius))
+        return keys
+
+    def draw_shape(self, tool, start, end):
+        path = self.shape_path(tool, start, end)
+        pen = self.shape_pen()
+        
+        self.begin_edit()
+        for tx, ty in self.tiles_for_path(path, self.brush_size / 2 + 1):
+            self.record_tile_before((tx, ty))
+            tile = self.get_tile(tx, ty)
+            painter = QPainter(tile.pixmap)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.translate(-(tx * self.tile_size - 1), -(ty * self.tile_size - 1))
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawPath(path)
+            painter.end()
+            self.mark_tile_dirty((tx, ty), tile)
+        self.end_edit()
+
+    def add_text(self, text, pos, font, color):
+        text_item = TextItem(text, pos, font, color)
+        self.insert_text_item(text_item)
+        self.document_changed()
+        return text_item
+
+    def insert_text_item(self, text_item):
+        self.text_items.insert(text_item, self.get_text_rect(text_item))
+
+    def reindex_text_item(self, text_item):
+        self.text_items.update(text_item, self.get_text_rect(text_item))
+
+    def get_text_rect(self, text_item):
+        bounds = self.get_text_bounds(text_item)
+        xs = [p.x() for p in bounds]
+        ys = [p.y() for p in bounds]
+        return QRectF(QPointF(min(xs), min(ys)), QPointF(max(xs), max(ys)))
+
+    def get_text_bounds(self, text_item):
+        return text_item.corners()
+
+    def rasterize_text(self, text_item):
+        # Bake the item into the active layer so image exports include it
+        _, static_text, origin = text_item.layout()
+        pad = QFontMetricsF(text_item.font).height() * 0.25 * text_item.scale
+        rect = self.get_text_rect(text_item).adjusted(-pad, -pad, pad, pad)
+        self.begin_edit()
+        for tx, ty in self.tiles_for_rect(rect):
+            self.record_tile_before((tx, ty))
+            tile = self.get_tile(tx, ty)
+            painter = QPainter(tile.pixmap)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            painter.translate(-(tx * self.tile_size - 1), -(ty * self.tile_size - 1))
+            painter.translate(text_item.pos)
+            painter.rotate(text_item.rotation)
+            painter.scale(text_item.scale, text_item.scale)
+            painter.setFont(text_item.font)
+            painter.setPen(QPen(text_item.color))
+            painter.drawStaticText(origin, static_text)
+            painter.end()
+            self.mark_tile_dirty((tx, ty), tile)
+        self.end_edit()
+        self.text_items.remove(text_item)
+        self.document_changed()
+
+    def clear_canvas(self):
+        self.end_stroke()
+        self.tiles.clear()
+        self.tile_store.clear()
+        self.pyramid.clear()
+        self.composites.clear()
+        self.history.clear()
+        self.rebase()
+        self.layers = [Layer(0, "Background")]
+        self.active_layer = self.layers[0]
+        self.next_layer_id = 1
+        if self.project is not None:
+            self.project.close()
+            self.project = None
+        self.document_changed()
+        
+    def rebase(self):
+        self.version += 1
+        self.base_version = self.version
+        self.tile_versions.clear()
+
+    def snapshot(self, keys=None):
+        # Frozen copy of the stored tiles (or just `keys`) and layers for workers
+        return TileSnapshot(self, keys)
+
+    def all_text_items(self):
+        return list(self.text_items)
+
+    def save_project(self, file_path):
+        if self.stroke is not None:
+            self.stroke.flush()
+            
+        incremental = self.project is not None and self.project.path == file_path
+        changed = {}
+        for key, tile in self.tiles.items():
+            if tile.dirty or not incremental:
+                changed[key] = TileStore.encode(tile.image(), 6)
+        for key in list(self.tile_store.keys()):
+            if key not in changed and (self.tile_store.index[key][4] or not incremental):
+                changed[key] = self.tile_store.read_raw(key)
+        texts = [item.to_dict() for item in self.all_text_items()]
+        layers = [layer.to_dict() for layer in self.layers]
+        live = {layer.id for layer in self.layers}
+        
+        if incremental:
+            project = self.project
+            keep = {key for key in project.keys() if key not in changed and key[0] in live}
+        else:
+            project = ProjectFile(file_path)
+            keep = set()
+            if self.project is not None:
+                # Tiles still only on disk in the old project are copied across
+                changed.update({key: self.project.read_raw(key) for key in self.project.keys()
+                                if key not in changed and key[0] in live})
+        project.write(changed, texts, layers, keep)
+        
+        if self.project is not None and self.project is not project:
+            self.project.close()
+        self.project = project
+        
+        # The project is now the backing copy of every saved tile
+        for key in changed:
+            self.tile_store.discard(key)
+        for tile in self.tiles.values():
+            tile.dirty = False
+            tile.spilled = False
+        self.rebase()
+        return True
+
+    def open_project(self, file_path):
+        project = ProjectFile.open(file_path)
+        self.clear_canvas()
+        self.text_items.clear()
+        self.text_sprites.clear()
+        self.project = project
+        self.layers = [Layer.from_dict(data) for data in project.layers]
+        self.active_layer = self.layers[-1]
+        self.next_layer_id = max(layer.id for layer in self.layers) + 1
+        for key in self.content_keys():
+            self.pyramid.invalidate(key)
+        for data in project.texts:
+            self.insert_text_item(TextItem.from_dict(data))
+        self.document_changed()
+
+    def autosave(self, journal):
+        # A job journaling what changed since the last checkpoint, or None if
+        # nothing did; only the tiles written since then are snapshotted
+        texts = [item.to_dict() for item in self.all_text_items()]
+        reset = journal.version is None or self.base_version > journal.version
+        if not reset and self.version == journal.version and texts == journal.texts:
+            return None
+        keys = {key for key, version in self.tile_versions.items()
+                if reset or version > journal.version}
+        return AutosaveJob(journal, self.snapshot(keys), texts)
+
+    def recover(self, journal):
+        # The journal's project, if it still exists, with the journaled layers,
+        # texts and tiles on top
+        self.clear_canvas()
+        if journal.project is not None and os.path.exists(journal.project):
+            try:
+                self.open_project(journal.project)
+            except (OSError, ValueError):
+                pass
+        if journal.layers:
+            self.layers = [Layer.from_dict(data) for data in journal.layers]
+            self.active_layer = self.layers[-1]
+            self.next_layer_id = max(layer.id for layer in self.layers) + 1
+        self.text_items.clear()
+        self.text_sprites.clear()
+        for data in journal.texts:
+            self.insert_text_item(TextItem.from_dict(data))
+        for key in journal.tiles:
+            layer = self.layer_by_id(key[0])
+            if layer is not None:
+                self.put_tile_image(key[1:], TileStore.decode(*journal.read_raw(key)), layer)
+        self.layers_changed()
+
+    def export_image(self, file_path):
+        if self.stroke is not None:
+            self.stroke.flush()
+        snapshot = self.snapshot()
+        if not snapshot.keys():
+            return None
+        return ExportJob(snapshot, self.tile_size, file_path)
+        
+    def save_image(self, file_path):
+        job = self.export_image(file_path)
+        if job is None:
+            return False
+        job.run()
+        return job.ok
+        
+    def put_tile_image(self, key, image, layer=None):
+        self.put_tile(key, CanvasTile.from_image(self.tile_size, image), layer)
+
+    def put_tile(self, key, tile, layer=None):
+        stored = self.layer_key(key, layer)
+        self.tiles.discard(stored)
+        self.tile_store.discard(stored)
+        self.tiles_allocated += 1
+        self.tiles.add(stored, tile)
+        self.mark_tile_dirty(key, tile, layer)
+        self.cleanup_unused_tiles()
+
+    def load_image(self, image):
+        self.clear_canvas()
+        
+        if isinstance(image, QPixmap):
+            image = image.toImage()
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        
+        tiles_y = (image.height() + self.tile_size - 1) // self.tile_size
+        for ty in range(tiles_y):
+            for key, tile_image in slice_tile_images(image, ty, self.tile_size):
+                self.put_tile_image(key, tile_image)
+        
+        self.document_changed()
+
+    def import_image(self, file_path):
+        # Unreadable files are rejected before the current drawing is cleared
+        reader = QImageReader(file_path)
+        if not reader.canRead() or not reader.size().isValid():
+            return None
+        self.clear_canvas()
+        job = ImportJob(file_path, self.tile_size)
+        job.tiles_ready.connect(lambda tiles: self.receive_imported_tiles(job, tiles))
+        return job
+
+    def receive_imported_tiles(self, job, tiles):
+        if job.cancelled:
+            # Strips queued before the cancel belong to the previous image; the
+            # worker still waits for each one to be consumed
+            job.strip_consumed()
+            return
+        for key, image in tiles:
+            self.put_tile_image(key, image)
+        job.strip_consumed()
+        self.document_changed()
+
+    def editable_tile_image(self, key):
+        image = self.get_tile_image(key)
+        if image is None:
+            image = QImage(self.tile_size + 2, self.tile_size + 2,
+                           QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+        return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+    def neighbour_keys(self, keys):
+        return {(tx + dx, ty + dy) for tx, ty in keys
+                for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+
+    def row_batches(self, keys):
+        # Whole tile rows, top to bottom, in groups of up to a quarter of the cache
+        # budget, so filters over big canvases let tiles be evicted between groups
+        rows = {}
+        for key in keys:
+            rows.setdefault(key[1], []).append(key)
+        limit = max(1, self.get_max_tiles_for_zoom() // 4)
+        batch = []
+        for ty in sorted(rows):
+            batch.extend(sorted(rows[ty]))
+            if len(batch) >= limit:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def commit_tile_batch(self, images, before):
+        # Before-images are compressed as each batch lands, and the whole filter
+        # still undoes as one step once the caller pushes `before`
+        before.update(self.capture_tiles([self.layer_key(key) for key in images]))
+        for key, image in images.items():
+            self.put_tile_image(key, image)
+
+    def map_tile_pixels(self, op):
+        # Pointwise ops touch each tile on its own, border included, so tiles
+        # are processed in parallel with no neighbour exchange
+        import pixel_ops
+        before = {}
+        with ThreadPoolExecutor() as pool:
+            for batch in self.row_batches(self.all_tile_keys()):
+                images = {key: self.editable_tile_image(key) for key in batch}
+                arrays = [pixel_ops.image_array(image) for image in images.values()]
+                list(pool.map(op, arrays))
+                self.commit_tile_batch(images, before)
+        if before:
+            self.history.push(before)
+        self.document_changed()
+
+    def invert_colors(self):
+        # pixel_ops pulls in NumPy, so it is imported on first use (tile compaction,
+        # image import, filters and fill) rather than at startup
+        import pixel_ops
+        self.map_tile_pixels(pixel_ops.invert)
+
+    def adjust_brightness_contrast(self, brightness, contrast):
+        import pixel_ops
+        self.map_tile_pixels(lambda pixels: pixel_ops.brightness_contrast(
+            pixels, brightness, contrast))
+
+    def blur(self, sigma):
+        if not sigma > 0:
+            raise ValueError(f"blur sigma must be positive, got {sigma!r}")
+        import pixel_ops
+        keys = self.all_tile_keys()
+        kernel = pixel_ops.gaussian_kernel(sigma, self.tile_size - 1)
+        sources = {}
+        arrays = {}
+        before = {}
+        with ThreadPoolExecutor() as pool:
+            for batch in self.row_batches(self.neighbour_keys(keys)):
+                # Each batch reads the original pixels of its tiles plus a one tile
+                # halo; the row above was loaded before the previous batch landed
+                for key in (self.neighbour_keys(batch) & keys) - sources.keys():
+                    sources[key] = self.editable_tile_image(key)
+                    arrays[key] = pixel_ops.image_array(sources[key])
+                results = pool.map(lambda key: pixel_ops.blur_tile(
+                    arrays, key, self.tile_size, kernel), batch)
+                # Blur spills into empty neighbours; only keep those that gained pixels
+                images = {key: pixel_ops.array_image(pixels) for key, pixels in zip(batch, results)
+                          if key in keys or pixels[..., 3].any()}
+                self.commit_tile_batch(images, before)
+                last_row = batch[-1][1]
+                for key in [key for key in sources if key[1] < last_row]:
+                    del arrays[key]
+                    del sources[key]
+        if before:
+            self.history.push(before)
+        self.document_changed()
+
+    def fill_bounds(self):
+        # Image pixels a fill may reach, as (left, top, right, bottom) with right and
+        # bottom exclusive: for a headless document, the extent an export covers
+        keys = self.content_keys()
+        if not keys:
+            return None
+        ts = self.tile_size
+        return (min(k[0] for k in keys) * ts, min(k[1] for k in keys) * ts,
+                (max(k[0] for k in keys) + 1) * ts, (max(k[1] for k in keys) + 1) * ts)
+
+    def uniform_tile_color(self, key):
+        # Premultiplied ARGB of a tile known to be one colour without decoding it:
+        # 0 for empty space, the value of a resident solid tile, else None
+        stored = self.layer_key(key)
+        if stored in self.tiles:
+            tile = self.tiles[stored]
+            return tile.data if tile.form == "solid" else None
+        return None if self.has_stored_tile(stored) else 0
+
+    def flood_fill(self, point, tolerance=32):
+        import pixel_ops
+        # Empty space is unbounded, so the fill stops at fill_bounds()
+        bounds = self.fill_bounds()
+        if bounds is None:
+            return
+        key, local = self.point_to_tile(point)
         
-        if icon_name:
-            icon = QIcon(icon_name)
-            self.setIcon(icon)
-            self.setIconSize(QSize(24, 24))
-            
-        self.update_style()
-        self.setCheckable(True)
-        if tooltip:
-            self.setToolTip(tooltip)
+        def load(key):
+            value = self.uniform_tile_color(key)
+            if value is not None:
+                return value
+            # Only the fill's match mask outlives this copy
+            image = self.editable_tile_image(key)
+            return pixel_ops.image_array(image).copy()
+        
+        masks = pixel_ops.flood_fill(load, key, int(local.x()), int(local.y()),
+                                     self.tile_size, bounds, tolerance)
+        if not masks:
+            return
+        color = pixel_ops.premultiplied_bgra(self.brush_color, self.opacity)
+        solids = {key: pixel_ops.fill_solid(self.uniform_tile_color(key), color)
+                  for key, mask in masks.items() if mask is True}
+        # Uniform tiles filled whole whose neighbours all end up the same colour
+        # become one solid value; no image is built for them
+        plain = {key: value for key, value in solids.items()
+                 if all(solids.get(other) == value for other in self.neighbour_keys([key]))}
+        changed = set(masks) | {key for key in self.neighbour_keys(masks) if self.has_tile(key)}
+        
+        def filled_image(key):
+            image = self.editable_tile_image(key)
+            if key in masks:
+                pixel_ops.fill_mask(pixel_ops.image_array(image), masks[key], color)
+            return image
+        
+        images = {}
+        arrays = {}
+        before = {}
+        for batch in self.row_batches(changed - plain.keys()):
+            # Like blur, each batch keeps a one tile halo for the border sync and
+            # drops rows the next batch no longer touches
+            for key in (self.neighbour_keys(batch) & changed) - images.keys():
+                images[key] = filled_image(key)
+                arrays[key] = pixel_ops.image_array(images[key])
+            pixel_ops.sync_borders(arrays, self.tile_size)
+            self.commit_tile_batch({key: images[key] for key in batch}, before)
+            last_row = batch[-1][1]
+            for key in [key for key in images if key[1] < last_row]:
+                del arrays[key]
+                del images[key]
+        for batch in self.row_batches(plain):
+            before.update(self.capture_tiles([self.layer_key(key) for key in batch]))
+            for key in batch:
+                self.put_tile(key, CanvasTile(self.tile_size, form="solid", data=plain[key]))
+        self.history.push(before)
+        self.document_changed()
+
+    def get_max_tiles_for_zoom(self):
+        if self.zoom < 0.1:  
+            return int(self.base_tile_limit * 0.3)  
+        elif self.zoom < 0.5:
+            return int(self.base_tile_limit * 0.6)  
+        elif self.zoom > 5.0:
+            return int(self.base_tile_limit * 1.5)  
+        else:
+            return self.base_tile_limit
+
+    def get_max_tile_bytes(self):
+        tile_bytes = (self.tile_size + 2) * (self.tile_size + 2) * 4
+        return self.get_max_tiles_for_zoom() * tile_bytes
+
+    def cleanup_unused_tiles(self):
+        max_bytes = self.get_max_tile_bytes()
+        if self.tiles.resident_bytes <= max_bytes:
+            return
             
-    def update_style(self):
-        bg_color = "#2b2b2b" if self.dark_mode else "#f8f9fa"
-        text_color = "#ffffff" if self.dark_mode else "#212529"
-        hover_color = "#3b3b3b" if self.dark_mode else "#e9ecef"
-        checked_color = "#0d6efd"
-        
-        self.setStyleSheet(f"""
-            QPushButton {{
-                border: none;
-                border-radius: 4px;
-                background-color: {bg_color};
-                color: {text_color};
-                font-size: 18px;
-                padding: 5px;
-            }}
-            QPushButton:hover {{
-                background-color: {hover_color};
-            }}
-            QPushButton:checked {{
-                background-color: {checked_color};
-                color: white;
-            }}
-        """)
+        started = time.perf_counter()
+        visible = self.get_visible_tiles()
+        protected = {(layer.id,) + key for layer in self.visible_layers() for key in visible}
+        if self.stroke is not None:
+            protected |= {(self.stroke.layer.id,) + key for key in self.stroke.protected_keys()}
+        self.tiles.evict_to(max_bytes, protected)
+        if self.profiler is not None:
+            self.profiler.add_time("cleanup", started)
 
-class ColorButton(QPushButton):
-    def __init__(self, color, dark_mode=False):
-        super().__init__()
-        self.setFixedSize(24, 24)
-        self.color = color
-        self.dark_mode = dark_mode
-        self.update_style()
-        
-    def update_style(self):
-        border_color = "#555555" if self.dark_mode else "#dee2e6"
-        hover_color = "#0d6efd"
-        self.setStyleSheet(f"""
-            QPushButton {{
-                background-color: {self.color};
-                border: 1px solid {border_color};
-                border-radius: 4px;
-                margin: 2px;
-            }}
-            QPushButton:hover {{
-                border: 2px solid {hover_color};
-            }}
-            QPushButton:checked {{
-                border: 2px solid {hover_color};
-            }}
-        """)
+    def set_profiling(self, enabled):
+        # Off means no profiler at all, so hot paths pay one attribute check
+        if enabled and self.profiler is None:
+            self.profiler = FrameProfiler(self)
+        elif not enabled:
+            self.profiler = None
+        self.document_changed()
 
-class CanvasTile:
-    def __init__(self, size=512):
-        self.pixmap = QPixmap(size + 2, size + 2)
-        self.pixmap.fill(Qt.transparent)
-        self.size = size
-        self.dirty = False
+    def apply_command(self, command):
+        # Commands are plain dicts such as {"op": "stroke", "points": [[x, y], ...]}
+        if not isinstance(command, dict):
+            raise ValueError("a command must be a JSON object")
+        handler = getattr(self, "run_" + str(command.get("op")), None)
+        if handler is None:
+            raise ValueError(f"unknown command {command.get('op')!r}")
+        handler(command)
 
-class TextItem:
-    def __init__(self, text, pos, font, color):
-        self.text = text
-        self.pos = pos
-        self.font = font
-        self.color = color
-        self.scale = 1.0
-        self.rotation = 0
-        self.selected = False
-        self.dragging = False
-        self.drag_start = None
-        self.original_pos = None
-        self.show_controls = False
-        self.last_click_time = 0
+    def run_set(self, command):
+        # Settings are checked here, so a bad value is reported against its own line
+        # rather than the stroke that would trip over it later
+        def number(name, minimum, maximum=None):
+            value = command[name]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                    not minimum <= value <= (math.inf if maximum is None else maximum):
+                limit = f"at least {minimum}" if maximum is None else f"from {minimum} to {maximum}"
+                raise ValueError(f"{name} must be a number {limit}, got {value!r}")
+            return value
+        
+        if "tool" in command:
+            if command["tool"] not in TOOLS:
+                raise ValueError(f"unknown tool {command['tool']!r}")
+            self.tool = command["tool"]
+        if "size" in command:
+            self.brush_size = number("size", 1)
+        if "color" in command:
+            color = QColor(command["color"])
+            if not color.isValid():
+                raise ValueError(f"invalid color {command['color']!r}")
+            self.brush_color = color
+        if "opacity" in command:
+            self.opacity = number("opacity", 0, 1)
+        if "hardness" in command:
+            self.brush_hardness = number("hardness", 0, 1)
+
+    def run_stroke(self, command):
+        self.run_set(command)
+        stroke = self.begin_stroke()
+        for timestamp, point in enumerate(command["points"]):
+            pressure = point[2] if len(point) > 2 else 1.0
+            stroke.add_point(QPointF(point[0], point[1]), timestamp, pressure)
+        self.end_stroke()
+
+    def run_shape(self, command):
+        if command["shape"] not in ["rectangle", "circle", "line"]:
+            raise ValueError(f"unknown shape {command['shape']!r}")
+        self.run_set(command)
+        self.draw_shape(command["shape"], QPointF(*command["start"]), QPointF(*command["end"]))
+
+    def run_text(self, command):
+        font = QFont(command.get("font", "Arial"))
+        font.setPointSizeF(command.get("size", 12))
+        item = self.add_text(command["text"], QPointF(*command["pos"]), font,
+                             QColor(command.get("color", "#000000")))
+        item.rotation = command.get("rotation", 0)
+        item.scale = command.get("scale", 1.0)
+        self.reindex_text_item(item)
+        if command.get("rasterize"):
+            self.rasterize_text(item)
+
+    def run_fill(self, command):
+        self.run_set(command)
+        self.flood_fill(QPointF(*command["point"]), command.get("tolerance", 32))
+
+    def run_blur(self, command):
+        self.blur(command.get("sigma", 2.0))
+
+    def run_invert(self, command):
+        self.invert_colors()
+
+    def run_adjust(self, command):
+        self.adjust_brightness_contrast(command.get("brightness", 0), command.get("contrast", 1.0))
+
+    def run_layer(self, command):
+        layer = self.add_layer(command.get("name"))
+        layer.visible = bool(command.get("visible", True))
+        self.set_layer_opacity(layer, command.get("opacity", 1.0))
+        self.set_layer_blend_mode(layer, command.get("blend_mode", "normal"))
+
+    def run_undo(self, command):
+        self.undo()
+
+    def run_redo(self, command):
+        self.redo()
+
+    def run_clear(self, command):
+        self.clear_canvas()
+
+    def run_open(self, command):
+        path = command["path"]
+        if path.lower().endswith(".pxp"):
+            self.open_project(path)
+            return
+        image = QImage(path)
+        if image.isNull():
+            raise ValueError(f"cannot read image {path}")
+        self.load_image(image)
+
+    def run_save(self, command):
+        path = command["path"]
+        if path.lower().endswith(".pxp"):
+            self.save_project(path)
+        elif not self.save_image(path):
+            raise ValueError(f"cannot write image {path}")
 
-class Canvas(QWidget):
+class Canvas(Document, QWidget):
     def __init__(self):
         super().__init__()
         self.init_canvas()
@@ -107,51 +3134,33 @@ class Canvas(QWidget):
         self.is_snapped = False
         
     def init_canvas(self):
-        self.tile_size = 256
-        self.tiles = {}
         self.last_point = None
         self.drawing = False
-        self.brush_size = 3
-        self.brush_color = QColor("#000000")
-        self.tool = "pen"
-        self.opacity = 1.0
-        self.zoom = 1.0
+        self.tablet_pressure = 1.0
         self.min_zoom = 0.05
         self.max_zoom = 10.0
         self.pan_start = None
         self.offset = QPointF(0, 0)
         self.background_color = Qt.white
-        self.text_items = {}
         self.selected_text = None
         self.rotating = False
         self.scaling = False
         self.rotation_start = None
         self.scale_start = None
         
-        self.max_tiles_in_memory = 500
-        self.tile_access_times = {}
-        self.cleanup_counter = 0
-        self.cleanup_threshold = 25
-        self.base_tile_limit = 500
-        
         self.visible_rect = QRectF(0, 0, self.width(), self.height())
         
         self.setMouseTracking(True)
-        self.buffer_image = QPixmap(self.tile_size * 2, self.tile_size * 2)
-        self.buffer_image.fill(Qt.transparent)
+        self.preview_end = None
+        self.hud_rect = QRect()
         
-    def get_tile(self, tx, ty):
-        key = (tx, ty)
-        self.tile_access_times[key] = time.time()
+        # Raw pointer events are buffered by the stroke and fitted once per frame
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setInterval(16)
+        self.stroke_timer.timeout.connect(self.fit_stroke_input)
         
-        if key not in self.tiles:
-            self.cleanup_counter += 1
-            if self.cleanup_counter >= self.cleanup_threshold:
-                self.cleanup_unused_tiles()
-                self.cleanup_counter = 0
-            
-            self.tiles[key] = CanvasTile(self.tile_size)
-        return self.tiles[key]
+    def document_changed(self):
+        self.update()
         
     def get_visible_tiles(self):
         visible_rect = QRectF(-self.offset.x(), -self.offset.y(),
@@ -166,92 +3175,38 @@ class Canvas(QWidget):
         return [(tx, ty) for tx in range(min_tx, max_tx + 1)
                         for ty in range(min_ty, max_ty + 1)]
         
-    def point_to_tile(self, point):
-        tx = int(point.x() // self.tile_size)
-        ty = int(point.y() // self.tile_size)
-        local_x = point.x() - tx * self.tile_size
-        local_y = point.y() - ty * self.tile_size
-        return (tx, ty), QPointF(local_x, local_y)
-        
-    def draw_line_between_points(self, start, end):
-        start_tile, start_local = self.point_to_tile(start)
-        end_tile, end_local = self.point_to_tile(end)
-        
-        min_tx = min(start_tile[0], end_tile[0]) - 1
-        max_tx = max(start_tile[0], end_tile[0]) + 1
-        min_ty = min(start_tile[1], end_tile[1]) - 1
-        max_ty = max(start_tile[1], end_tile[1]) + 1
+    def fill_bounds(self):
+        # A fill reaches as far as the view shows
+        left = -self.offset.x()
+        top = -self.offset.y()
+        return (math.floor(left), math.floor(top),
+                math.ceil(left + self.width() / self.zoom), math.ceil(top + self.height() / self.zoom))
         
-        for tx in range(min_tx, max_tx + 1):
-            for ty in range(min_ty, max_ty + 1):
-                tile = self.get_tile(tx, ty)
-                
-                tile_start = QPointF(start.x() - (tx * self.tile_size - 1),
-                                   start.y() - (ty * self.tile_size - 1))
-                tile_end = QPointF(end.x() - (tx * self.tile_size - 1),
-                                 end.y() - (ty * self.tile_size - 1))
-                
-                painter = QPainter(tile.pixmap)
-                painter.setRenderHint(QPainter.Antialiasing)
-                
-                if self.tool in ["pen", "brush"]:
-                    pen = QPen()
-                    pen.setWidthF(self.brush_size / self.zoom)
-                    pen.setColor(self.brush_color)
-                    pen.setCapStyle(Qt.RoundCap)
-                    pen.setJoinStyle(Qt.RoundJoin)
-                    painter.setOpacity(self.opacity)
-                    painter.setPen(pen)
-                    painter.drawLine(tile_start, tile_end)
-                elif self.tool == "eraser":
-                    painter.setCompositionMode(QPainter.CompositionMode_Clear)
-                    pen = QPen()
-                    pen.setWidthF(self.brush_size * 2 / self.zoom)
-                    pen.setCapStyle(Qt.RoundCap)
-                    pen.setJoinStyle(Qt.RoundJoin)
-                    painter.setPen(pen)
-                    painter.drawLine(tile_start, tile_end)
-                
-                painter.end()
-                tile.dirty = True
+    def end_stroke(self):
+        self.stroke_timer.stop()
+        super().end_stroke()
 
     def add_text(self, text, pos, font, color):
         font.setPointSize(12)
-        text_item = TextItem(text, pos, font, color)
-        tx = int(pos.x() // self.tile_size)
-        ty = int(pos.y() // self.tile_size)
-        tile_key = (tx, ty)
-        
-        if tile_key not in self.text_items:
-            self.text_items[tile_key] = []
-        self.text_items[tile_key].append(text_item)
-        
+        text_item = super().add_text(text, pos, font, color)
         self.selected_text = text_item
         text_item.selected = True
-        self.update()
+        return text_item
 
-    def get_text_bounds(self, text_item):
-        temp_pixmap = QPixmap(1, 1)
-        painter = QPainter(temp_pixmap)
-        painter.setFont(text_item.font)
-        text_rect = painter.fontMetrics().boundingRect(text_item.text)
-        painter.end()
-        
-        width = text_rect.width() * text_item.scale
-        height = text_rect.height() * text_item.scale
-        
-        transform = QTransform()
-        transform.translate(text_item.pos.x(), text_item.pos.y())
-        transform.rotate(text_item.rotation)
-        
-        points = [
-            transform.map(QPointF(-width/2, -height/2)),
-            transform.map(QPointF(width/2, -height/2)),
-            transform.map(QPointF(width/2, height/2)),
-            transform.map(QPointF(-width/2, height/2))
-        ]
-        
-        return points
+    def open_project(self, file_path):
+        super().open_project(file_path)
+        self.selected_text = None
+
+    def fit_stroke_input(self):
+        if self.stroke is None:
+            self.stroke_timer.stop()
+            return
+        started = time.perf_counter()
+        dirty = self.stroke.fit()
+        if self.profiler is not None:
+            self.profiler.add_time("stroke", started)
+        if not dirty.isEmpty():
+            self.update_image_rect(dirty)
 
     def get_text_handles(self, text_item):
         bounds = self.get_text_bounds(text_item)
@@ -276,57 +3231,69 @@ class Canvas(QWidget):
         return (point1 - point2).manhattanLength() < scaled_threshold
 
     def draw_text_items(self, painter):
-        visible_tiles = self.get_visible_tiles()
-        
-        for tx, ty in visible_tiles:
-            if (tx, ty) in self.text_items:
-                for item in self.text_items[(tx, ty)]:
-                    painter.save()
-                    painter.scale(self.zoom, self.zoom)
-                    painter.translate(self.offset.x(), self.offset.y())
-                    painter.translate(item.pos.x(), item.pos.y())
-                    painter.rotate(item.rotation)
-                    painter.scale(item.scale, item.scale)
-                    
-                    painter.setFont(item.font)
-                    painter.setPen(QPen(item.color))
-                    
-                    text_rect = painter.fontMetrics().boundingRect(item.text)
-                    painter.drawText(-text_rect.width()/2, text_rect.height()/2, item.text)
-                    
-                    if item.selected and item.show_controls:
-                        painter.resetTransform()
-                        painter.scale(self.zoom, self.zoom)
-                        painter.translate(self.offset.x(), self.offset.y())
-                        bounds = self.get_text_bounds(item)
-                        painter.setPen(QPen(Qt.blue, 1/self.zoom, Qt.DashLine))
-                        path = QPainterPath()
-                        path.moveTo(bounds[0])
-                        for p in bounds[1:]:
-                            path.lineTo(p)
-                        path.closeSubpath()
-                        painter.drawPath(path)
-                        rotation_handle, scale_handle = self.get_text_handles(item)
-                        
-                        painter.setPen(QPen(Qt.blue, 2/self.zoom))
-                        painter.setBrush(Qt.white)
-                        
-                        handle_size = 12/self.zoom
-                        painter.drawEllipse(rotation_handle, handle_size/2, handle_size/2)
-                        painter.drawLine(item.pos, rotation_handle)
-                        
-                        painter.drawRect(QRectF(scale_handle.x() - handle_size/2, 
-                                              scale_handle.y() - handle_size/2,
-                                              handle_size, handle_size))
-                    
-                    painter.restore()
+        visible_rect = QRectF(-self.offset.x(), -self.offset.y(),
+                              self.width() / self.zoom, self.height() / self.zoom)
+        
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        if self.text_sprites is not None:
+            self.text_sprites.begin_frame()
+        drawn = 0
+        for item in self.text_items.query(visible_rect):
+            drawn += 1
+            painter.save()
+            
+            # Items being rotated or scaled change every frame, so draw them as vectors
+            interactive = item is self.selected_text and (self.rotating or self.scaling)
+            if self.text_sprites is None or interactive or \
+                    not self.text_sprites.draw(painter, item, self.zoom, self.offset):
+                painter.scale(self.zoom, self.zoom)
+                painter.translate(self.offset.x(), self.offset.y())
+                painter.translate(item.pos.x(), item.pos.y())
+                painter.rotate(item.rotation)
+                painter.scale(item.scale, item.scale)
+                
+                painter.setFont(item.font)
+                painter.setPen(QPen(item.color))
+                
+                _, static_text, origin = item.layout()
+                painter.drawStaticText(origin, static_text)
+            
+            if item.selected and item.show_controls:
+                painter.resetTransform()
+                painter.scale(self.zoom, self.zoom)
+                painter.translate(self.offset.x(), self.offset.y())
+                bounds = self.get_text_bounds(item)
+                painter.setPen(QPen(Qt.blue, 1/self.zoom, Qt.DashLine))
+                path = QPainterPath()
+                path.moveTo(bounds[0])
+                for p in bounds[1:]:
+                    path.lineTo(p)
+                path.closeSubpath()
+                painter.drawPath(path)
+                rotation_handle, scale_handle = self.get_text_handles(item)
+                
+                painter.setPen(QPen(Qt.blue, 2/self.zoom))
+                painter.setBrush(Qt.white)
+                
+                handle_size = 12/self.zoom
+                painter.drawEllipse(rotation_handle, handle_size/2, handle_size/2)
+                painter.drawLine(item.pos, rotation_handle)
+                
+                painter.drawRect(QRectF(scale_handle.x() - handle_size/2, 
+                                      scale_handle.y() - handle_size/2,
+                                      handle_size, handle_size))
+            
+            painter.restore()
+        return drawn
 
     def mousePressEvent(self, event):
         pos = self.map_to_image(event.position())
         
         if event.button() == Qt.LeftButton:
             if self.tool in ["text", "select"]:
+                handled = False
                 if self.selected_text:
+                    handled = True
                     rotation_handle, scale_handle = self.get_text_handles(self.selected_text)
                     if self.is_near_point(pos, rotation_handle):
                         self.rotating = True
@@ -341,24 +3308,20 @@ class Canvas(QWidget):
                         self.start_scale = self.selected_text.scale
                         self.start_dist = math.sqrt((pos.x() - self.scale_origin.x())**2 + 
                                                   (pos.y() - self.scale_origin.y())**2)
-                    else:
+                    elif self.is_point_in_text(pos, self.selected_text):
                         self.selected_text.dragging = True
                         self.selected_text.drag_start = pos
                         self.selected_text.original_pos = self.selected_text.pos
-                else:
+                    else:
+                        handled = False
+                
+                if not handled:
                     if self.selected_text:
                         self.selected_text.selected = False
                         self.selected_text.show_controls = False
                         self.selected_text = None
                     
-                    clicked_text = None
-                    for tile_texts in self.text_items.values():
-                        for item in reversed(tile_texts):
-                            if self.is_point_in_text(pos, item):
-                                clicked_text = item
-                                break
-                        if clicked_text:
-                            break
+                    clicked_text = self.text_items.item_at(pos, self.is_point_in_text)
                     
                     if clicked_text:
                         self.selected_text = clicked_text
@@ -370,6 +3333,8 @@ class Canvas(QWidget):
                             font_ok, font = QFontDialog.getFont()
                             if font_ok:
                                 self.add_text(text, pos, font, self.brush_color)
+            elif self.tool == "fill":
+                self.flood_fill(pos)
             else:
                 if self.selected_text:
                     self.selected_text.selected = False
@@ -378,10 +3343,31 @@ class Canvas(QWidget):
                 self.drawing = True
                 self.last_point = pos
                 self.start_point = pos
+                if self.tool in ["pen", "brush", "eraser"]:
+                    self.begin_stroke().add_point(pos, event.timestamp(),
+                                                  self.event_pressure(event))
+                    self.stroke_timer.start()
 
     def mouseMoveEvent(self, event):
         pos = self.map_to_image(event.position())
         
+        item = self.selected_text
+        if item and (item.dragging or self.rotating or self.scaling):
+            if item.dragging:
+                item.pos = item.original_pos + (pos - item.drag_start)
+            elif self.rotating:
+                angle = math.degrees(math.atan2(pos.y() - item.pos.y(), pos.x() - item.pos.x()))
+                item.rotation = (self.initial_rotation + angle - self.rotation_start) % 360
+                self.degree_pos = event.position() + QPointF(25, -25)
+            elif self.start_dist > 0:
+                dist = math.sqrt((pos.x() - self.scale_origin.x())**2 +
+                                 (pos.y() - self.scale_origin.y())**2)
+                item.scale = max(0.1, self.start_scale * dist / self.start_dist)
+            item.show_controls = False
+            self.reindex_text_item(item)
+            self.update()
+            return
+        
         if event.button() == Qt.MiddleButton and self.pan_start:
             delta = event.position() - self.pan_start
             self.offset += delta / self.zoom
@@ -391,9 +3377,16 @@ class Canvas(QWidget):
             
         if self.drawing and self.last_point:
             if self.tool in ["pen", "brush", "eraser"]:
-                self.draw_line_between_points(self.last_point, pos)
+                if self.stroke is not None:
+                    self.stroke.add_point(pos, event.timestamp(), self.event_pressure(event))
+            elif self.tool in ["rectangle", "circle", "line"]:
+                dirty = self.shape_update_rect(self.tool, self.start_point, pos)
+                if self.preview_end is not None:
+                    dirty = dirty.united(self.shape_update_rect(self.tool, self.start_point,
+                                                                self.preview_end))
+                self.preview_end = pos
+                self.update(dirty)
             self.last_point = pos
-            self.update()
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -408,59 +3401,58 @@ class Canvas(QWidget):
             elif self.drawing:
                 if self.tool in ["rectangle", "circle", "line"]:
                     pos = self.map_to_image(event.position())
-                    min_x = min(self.start_point.x(), pos.x())
-                    max_x = max(self.start_point.x(), pos.x())
-                    min_y = min(self.start_point.y(), pos.y())
-                    max_y = max(self.start_point.y(), pos.y())
-                    
-                    min_tx = int(min_x // self.tile_size) - 1
-                    max_tx = int(max_x // self.tile_size) + 1
-                    min_ty = int(min_y // self.tile_size) - 1
-                    max_ty = int(max_y // self.tile_size) + 1
-                    
-                    for tx in range(min_tx, max_tx + 1):
-                        for ty in range(min_ty, max_ty + 1):
-                            tile = self.get_tile(tx, ty)
-                            painter = QPainter(tile.pixmap)
-                            painter.setRenderHint(QPainter.Antialiasing)
-                            
-                            local_start = QPointF(self.start_point.x() - tx * self.tile_size,
-                                                self.start_point.y() - ty * self.tile_size)
-                            local_end = QPointF(pos.x() - tx * self.tile_size,
-                                              pos.y() - ty * self.tile_size)
-                            
-                            pen = QPen(self.brush_color)
-                            pen.setWidth(self.brush_size)
-                            pen.setCapStyle(Qt.RoundCap)
-                            pen.setJoinStyle(Qt.RoundJoin)
-                            painter.setPen(pen)
-                            
-                            if self.tool == "rectangle":
-                                painter.drawRect(QRectF(local_start, local_end))
-                            elif self.tool == "circle":
-                                painter.drawEllipse(QRectF(local_start, local_end))
-                            elif self.tool == "line":
-                                painter.drawLine(local_start, local_end)
-                            
-                            painter.end()
-                            tile.dirty = True
-                    
-                    self.buffer_image.fill(Qt.transparent)
+                    self.draw_shape(self.tool, self.start_point, pos)
+                    self.preview_end = None
                 
+                self.end_stroke()
                 self.drawing = False
                 self.last_point = None
                 self.update()
         elif event.button() == Qt.MiddleButton:
             self.pan_start = None
 
+    def tabletEvent(self, event):
+        # Leave the event unaccepted so Qt delivers the matching mouse event;
+        # the mouse handlers pick the pressure up from here
+        self.tablet_pressure = event.pressure()
+        event.ignore()
+
+    def event_pressure(self, event):
+        if event.device().type() in (QInputDevice.DeviceType.Stylus,
+                                     QInputDevice.DeviceType.Airbrush):
+            return self.tablet_pressure
+        return 1.0
+
     def map_to_image(self, pos):
         return pos / self.zoom - self.offset
+
+    def map_from_image_rect(self, rect):
+        return QRectF((rect.topLeft() + self.offset) * self.zoom,
+                      (rect.bottomRight() + self.offset) * self.zoom)
+
+    def shape_update_rect(self, tool, start, end):
+        radius = self.brush_size / 2 + 1
+        bounds = self.shape_path(tool, start, end).boundingRect()
+        return self.map_from_image_rect(bounds.adjusted(-radius, -radius, radius, radius)
+                                        ).toAlignedRect().adjusted(-2, -2, 2, 2)
+
+    def update_image_rect(self, rect):
+        # Qt unions every rect queued before the next frame into one paint
+        self.update(self.map_from_image_rect(rect).toAlignedRect().adjusted(-2, -2, 2, 2))
+        if self.profiler is not None:
+            self.update(self.hud_rect)
         
     def resizeEvent(self, event):
         super().resizeEvent(event)
         self.visible_rect = QRectF(0, 0, self.width(), self.height())
         
     def paintEvent(self, event):
+        frame_start = time.perf_counter()
+        if self.stroke is not None:
+            self.stroke.flush()
+            
+        tiles_start = time.perf_counter()
+        tiles_drawn = 0
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing)
         
@@ -470,19 +3462,49 @@ class Canvas(QWidget):
         painter.scale(self.zoom, self.zoom)
         painter.translate(self.offset.x(), self.offset.y())
         
-        visible_tiles = self.get_visible_tiles()
+        exposed = event.rect()
+        exposed_rect = QRectF(self.map_to_image(QPointF(exposed.topLeft())),
+                              self.map_to_image(QPointF(exposed.bottomRight()) + QPointF(1, 1)))
         
-        for tx, ty in visible_tiles:
-            tile = self.get_tile(tx, ty)
-            x = tx * self.tile_size - 1
-            y = ty * self.tile_size - 1
-            painter.drawPixmap(x, y, tile.pixmap)
+        level = self.pyramid.level_for_zoom(self.zoom)
+        if level == 0:
+            for tx, ty in self.tiles_for_rect(exposed_rect):
+                pixmap = self.composite_tile((tx, ty))
+                if pixmap is None:
+                    continue
+                x = tx * self.tile_size - 1
+                y = ty * self.tile_size - 1
+                painter.drawPixmap(x, y, pixmap)
+                tiles_drawn += 1
+        else:
+            # Cold levels build within a per-frame budget; tiles still building
+            # show a placeholder and another frame is queued to carry on
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            span = self.tile_size << level
+            deadline = tiles_start + self.pyramid.frame_budget
+            building = False
+            for lx, ly in self.pyramid.keys_for_rect(level, exposed_rect):
+                pixmap = self.pyramid.get_within(level, lx, ly, deadline)
+                source = QRectF(pixmap.rect()) if pixmap is not None else None
+                if pixmap is None and not self.pyramid.is_blank(level, lx, ly):
+                    building = True
+                    pixmap, source = self.pyramid.placeholder(level, lx, ly)
+                if pixmap is not None:
+                    painter.drawPixmap(QRectF(lx * span, ly * span, span, span), pixmap, source)
+                    tiles_drawn += 1
+            if building:
+                QTimer.singleShot(0, self.update)
         
-        if self.drawing and self.tool in ["rectangle", "circle", "line"]:
-            painter.drawPixmap(0, 0, self.buffer_image)
+        if self.drawing and self.preview_end is not None and \
+                self.tool in ["rectangle", "circle", "line"]:
+            painter.setPen(self.shape_pen())
+            painter.setBrush(Qt.NoBrush)
+            painter.drawPath(self.shape_path(self.tool, self.start_point, self.preview_end))
         
         painter.resetTransform()
-        self.draw_text_items(painter)
+        text_start = time.perf_counter()
+        text_items = self.draw_text_items(painter)
+        text_end = time.perf_counter()
         
         if self.rotating and self.selected_text and self.degree_pos:
             font = painter.font()
@@ -498,72 +3520,53 @@ class Canvas(QWidget):
             painter.fillRect(text_rect, QColor(0, 120, 215))
             painter.setPen(Qt.white)
             painter.drawText(self.degree_pos, degree_text)
-        
-    def clear_canvas(self):
-        self.tiles.clear()
-        self.update()
-        
-    def save_image(self, file_path):
-        if not self.tiles:
-            return False
             
-        min_tx = min(x for x, y in self.tiles.keys())
-        max_tx = max(x for x, y in self.tiles.keys())
-        min_ty = min(y for x, y in self.tiles.keys())
-        max_ty = max(y for x, y in self.tiles.keys())
-        
-        width = (max_tx - min_tx + 1) * self.tile_size
-        height = (max_ty - min_ty + 1) * self.tile_size
-        
-        result = QImage(width, height, QImage.Format_ARGB32)
-        result.fill(Qt.white)
-        
-        painter = QPainter(result)
-        for tx in range(min_tx, max_tx + 1):
-            for ty in range(min_ty, max_ty + 1):
-                if (tx, ty) in self.tiles:
-                    tile = self.tiles[(tx, ty)]
-                    x = (tx - min_tx) * self.tile_size
-                    y = (ty - min_ty) * self.tile_size
-                    painter.drawImage(x, y, tile.pixmap.toImage())
-        painter.end()
-        
-        return result.save(file_path)
-        
-    def load_image(self, image):
-        self.clear_canvas()
-        
-        if isinstance(image, QPixmap):
-            image = image.toImage()
-        
-        width = image.width()
-        height = image.height()
-        
-        tiles_x = (width + self.tile_size - 1) // self.tile_size
-        tiles_y = (height + self.tile_size - 1) // self.tile_size
-        
-        chunk_size = 10 
-        for tx_chunk in range(0, tiles_x, chunk_size):
-            for ty_chunk in range(0, tiles_y, chunk_size):
-                tx_end = min(tx_chunk + chunk_size, tiles_x)
-                ty_end = min(ty_chunk + chunk_size, tiles_y)
-                
-                for tx in range(tx_chunk, tx_end):
-                    for ty in range(ty_chunk, ty_end):
-                        tile = self.get_tile(tx, ty)
-                        tile.pixmap.fill(Qt.transparent)
-                        
-                        painter = QPainter(tile.pixmap)
-                        source_rect = QRect(tx * self.tile_size, ty * self.tile_size,
-                                          self.tile_size, self.tile_size)
-                        target_rect = QRect(0, 0, self.tile_size, self.tile_size)
-                        painter.drawImage(target_rect, image, source_rect)
-                        painter.end()
-                
-                self.cleanup_unused_tiles()
+        if self.profiler is not None:
+            self.profiler.add_time("stroke", frame_start, tiles_start)
+            self.profiler.add_time("tiles", tiles_start, text_start)
+            self.profiler.add_time("text", text_start, text_end)
+            self.draw_profiler_hud(painter)
+            self.profiler.end_frame(self, frame_start, tiles_drawn, text_items)
+            
+    def draw_profiler_hud(self, painter):
+        summary = self.profiler.summary()
+        if summary is None:
+            return
+        last = summary["last"]
+        lines = [
+            f"frame {last['frame_ms']:.1f} ms  p50 {summary['p50_ms']:.1f}  "
+            f"p95 {summary['p95_ms']:.1f}  max {summary['max_ms']:.1f}  {summary['fps']:.0f} fps",
+            f"stroke {last['stroke_ms']:.1f}  tiles {last['tiles_ms']:.1f}  "
+            f"text {last['text_ms']:.1f}  cleanup {last['cleanup_ms']:.1f} ms",
+            f"tiles {last['tiles_drawn']} drawn  +{last['tiles_allocated']} allocated  "
+            f"-{last['tiles_evicted']} evicted  {last['resident_kb'] // 1024} MB resident",
+            f"text items {last['text_items']}",
+        ]
+        painter.save()
+        font = QFont("monospace")
+        font.setStyleHint(QFont.Monospace)
+        font.setPointSize(9)
+        painter.setFont(font)
+        metrics = painter.fontMetrics()
+        line_height = metrics.height()
+        graph_height = 40
+        width = max(metrics.horizontalAdvance(line) for line in lines) + 16
+        height = line_height * len(lines) + graph_height + 20
+        self.hud_rect = QRect(8, 8, width, height)
+        painter.fillRect(self.hud_rect, QColor(0, 0, 0, 170))
+        painter.setPen(Qt.white)
+        for i, line in enumerate(lines):
+            painter.drawText(16, 12 + metrics.ascent() + i * line_height, line)
+            
+        # Frame time graph, one bar per frame, 33 ms full scale; red above 16.7 ms
+        base = 8 + height - 8
+        bar = max(1, (width - 16) // len(summary["frame_times"]))
+        for i, frame_ms in enumerate(summary["frame_times"][-((width - 16) // bar):]):
+            bar_height = min(graph_height, frame_ms * graph_height / 33.3)
+            color = QColor(230, 80, 60) if frame_ms > 16.7 else QColor(90, 200, 120)
+            painter.fillRect(QRectF(16 + i * bar, base - bar_height, bar, bar_height), color)
+        painter.restore()
         
-        self.update()
-
     def wheelEvent(self, event):
         if event.modifiers() & Qt.ControlModifier:
             if self.selected_text:
@@ -584,36 +3587,6 @@ class Canvas(QWidget):
         else:
             super().wheelEvent(event)
 
-    def get_max_tiles_for_zoom(self):
-        if self.zoom < 0.1:  
-            return int(self.base_tile_limit * 0.3)  
-        elif self.zoom < 0.5:
-            return int(self.base_tile_limit * 0.6)  
-        elif self.zoom > 5.0:
-            return int(self.base_tile_limit * 1.5)  
-        else:
-            return self.base_tile_limit
-
-    def cleanup_unused_tiles(self):
-        current_max_tiles = self.get_max_tiles_for_zoom()
-        if len(self.tiles) <= current_max_tiles:
-            return
-            
-        visible = set(self.get_visible_tiles())
-        
-        sorted_tiles = sorted(
-            self.tile_access_times.items(),
-            key=lambda x: x[1]
-        )
-        
-        for (tx, ty), _ in sorted_tiles:
-            if len(self.tiles) <= current_max_tiles:
-                break
-                
-            if (tx, ty) not in visible:
-                self.tiles.pop((tx, ty), None)
-                self.tile_access_times.pop((tx, ty), None)
-
     def update_window_title(self):
         zoom_percentage = int(self.zoom * 100)
         self.parent().setWindowTitle(f"Paint X - {zoom_percentage}% Zoom")
@@ -622,14 +3595,39 @@ class PaintX(QMainWindow):
     def __init__(self):
         super().__init__()
         self.dark_mode = False
-        icon = QIcon("icons/icon.png")
-        self.setWindowIcon(icon)
+        self.export_job = None
+        self.import_job = None
+        icon = load_icon("icons/icon.png")
+        if icon is not None:
+            self.setWindowIcon(icon)
         
         self.init_ui()
         
+        QShortcut(QKeySequence.Undo, self, self.canvas.undo)
+        QShortcut(QKeySequence.Redo, self, self.canvas.redo)
+        QShortcut(QKeySequence("F3"), self, self.toggle_profiling)
+        QShortcut(QKeySequence("Shift+F3"), self, self.save_profile)
+        
+        # Unsaved work is journaled in the background, one journal per running
+        # instance; an unlocked journal at startup means its session did not exit
+        # cleanly
+        self.autosave_job = None
+        self.orphans = AutosaveJournal.orphans(AUTOSAVE_DIR)
+        self.recovered = None
+        self.journal = AutosaveJournal.claim(AUTOSAVE_DIR)
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setInterval(AUTOSAVE_INTERVAL)
+        self.autosave_timer.timeout.connect(self.autosave)
+        if self.orphans:
+            QTimer.singleShot(0, self.offer_recovery)
+        else:
+            self.autosave_timer.start()
+        
     def init_ui(self):
         self.setWindowTitle("Paint X - 100% Zoom")
         self.setMinimumSize(800, 600)
+        # Styled before any child exists, so each widget is polished once when shown
+        self.update_styles()
         
         main_widget = QWidget()
         self.setCentralWidget(main_widget)
@@ -657,11 +3655,12 @@ class PaintX(QMainWindow):
             ("⭕", "circle", "Circle Tool", "icons/circle.png"),
             ("📏", "line", "Line Tool", "icons/line.png"),
             ("🧽", "eraser", "Eraser Tool", "icons/eraser.png"),
+            ("🪣", "fill", "Fill Tool", "icons/fill.png"),
             ("T", "text", "Text Tool", "icons/text.png")
         ]
 
         for text, tool, tooltip, icon_path in tools:
-            btn = ToolButton(text, icon_name=icon_path, tooltip=tooltip, dark_mode=self.dark_mode)
+            btn = ToolButton(text, icon_name=icon_path, tooltip=tooltip)
             btn.clicked.connect(lambda checked, t=tool: self.set_tool(t))
             tools_layout.addWidget(btn)
             self.tool_buttons[tool] = btn
@@ -679,33 +3678,15 @@ class PaintX(QMainWindow):
         colors_layout.setContentsMargins(4, 4, 4, 4)
         top_toolbar.addWidget(colors_frame)
         
-        primary_colors = [
-            "#000000", "#ffffff", "#808080",  
-            "#ff0000", "#ff8000", "#ffff00",  
-            "#00ff00", "#00ffff", "#0000ff",  
-            "#ff00ff", "#800000", "#008000"  
-        ]
-        
-        for color in primary_colors:
-            btn = ColorButton(color, dark_mode=self.dark_mode)
+        for color in PRIMARY_COLORS:
+            btn = ColorButton(color)
             btn.setCheckable(True)
             btn.clicked.connect(lambda checked, c=color: self.set_color(QColor(c)))
             colors_layout.addWidget(btn)
             
-        custom_color_btn = QPushButton()
+        custom_color_btn = IconButton("", "icons/color_picker.png")
+        custom_color_btn.setObjectName("customColor")
         custom_color_btn.setFixedSize(24, 24)
-        custom_color_btn.setIcon(QIcon("icons/color_picker.png"))
-        custom_color_btn.setStyleSheet("""
-            QPushButton {
-                background-color: white;
-                border: 1px solid #dee2e6;
-                border-radius: 4px;
-                margin: 2px;
-            }
-            QPushButton:hover {
-                border: 2px solid #0d6efd;
-            }
-        """)
         custom_color_btn.clicked.connect(self.choose_color)
         colors_layout.addWidget(custom_color_btn)
         
@@ -724,18 +3705,12 @@ class PaintX(QMainWindow):
         
         size_label = QLabel("Size:")
         size_label.setFixedWidth(35)
-        size_label.setStyleSheet("font-size: 12px;")
+        size_label.setProperty("role", "setting")
         settings_layout.addWidget(size_label)
         
         self.size_preview = QLabel()
+        self.size_preview.setObjectName("sizePreview")
         self.size_preview.setFixedSize(32, 32)
-        self.size_preview.setStyleSheet("""
-            QLabel {
-                background-color: white;
-                border: 1px solid #dee2e6;
-                border-radius: 4px;
-            }
-        """)
         settings_layout.addWidget(self.size_preview)
         
         self.size_slider = QSlider(Qt.Horizontal)
@@ -750,7 +3725,7 @@ class PaintX(QMainWindow):
         
         opacity_label = QLabel("Opacity:")
         opacity_label.setFixedWidth(50)
-        opacity_label.setStyleSheet("font-size: 12px;")
+        opacity_label.setProperty("role", "setting")
         settings_layout.addWidget(opacity_label)
         
         self.opacity_slider = QSlider(Qt.Horizontal)
@@ -761,6 +3736,50 @@ class PaintX(QMainWindow):
         self.opacity_slider.valueChanged.connect(self.change_opacity)
         settings_layout.addWidget(self.opacity_slider)
         
+        layers_separator = QFrame()
+        layers_separator.setFrameShape(QFrame.VLine)
+        layers_separator.setFrameShadow(QFrame.Sunken)
+        layers_separator.setMaximumHeight(30)
+        top_toolbar.addWidget(layers_separator)
+        
+        layers_frame = QFrame()
+        layers_frame.setMaximumHeight(50)
+        layers_layout = QHBoxLayout(layers_frame)
+        layers_layout.setSpacing(2)
+        layers_layout.setContentsMargins(2, 2, 2, 2)
+        top_toolbar.addWidget(layers_frame)
+        
+        self.layer_combo = QComboBox()
+        self.layer_combo.setFixedWidth(110)
+        self.layer_combo.setToolTip("Active Layer")
+        self.layer_combo.activated.connect(self.select_layer)
+        layers_layout.addWidget(self.layer_combo)
+        
+        layer_buttons = [
+            ("➕", self.add_layer, "Add Layer"),
+            ("➖", self.remove_layer, "Remove Layer"),
+            ("👁", self.toggle_layer_visibility, "Show/Hide Layer"),
+        ]
+        for text, func, tooltip in layer_buttons:
+            btn = QPushButton(text)
+            btn.setFixedSize(28, 28)
+            btn.setToolTip(tooltip)
+            btn.clicked.connect(func)
+            layers_layout.addWidget(btn)
+        
+        self.blend_combo = QComboBox()
+        self.blend_combo.addItems(list(BLEND_MODES))
+        self.blend_combo.setToolTip("Blend Mode")
+        self.blend_combo.activated.connect(self.change_layer_blend_mode)
+        layers_layout.addWidget(self.blend_combo)
+        
+        self.layer_opacity_spin = QSpinBox()
+        self.layer_opacity_spin.setRange(0, 100)
+        self.layer_opacity_spin.setSuffix("%")
+        self.layer_opacity_spin.setToolTip("Layer Opacity")
+        self.layer_opacity_spin.valueChanged.connect(self.change_layer_opacity)
+        layers_layout.addWidget(self.layer_opacity_spin)
+        
         separator3 = QFrame()
         separator3.setFrameShape(QFrame.VLine)
         separator3.setFrameShadow(QFrame.Sunken)
@@ -778,23 +3797,14 @@ class PaintX(QMainWindow):
             ("💾", self.save_image, "icons/save.png"),
             ("📂", self.load_image, "icons/load.png"),
             ("🗑️", self.clear_canvas, "icons/clear.png"),
+            ("✨", self.apply_filter, "icons/filter.png"),
             ("🌙", self.toggle_dark_mode, "icons/dark_mode.png")
         ]
         
         for text, func, icon_path in file_buttons:
-            btn = QPushButton(text)
+            btn = IconButton(text, icon_path, 20)
+            btn.setProperty("role", "file")
             btn.setFixedSize(32, 32)
-            if icon_path:
-                icon = QIcon(icon_path)
-                btn.setIcon(icon)
-                btn.setIconSize(QSize(20, 20))
-            btn.setStyleSheet("""
-                QPushButton {
-                    font-size: 16px;
-                    border: 1px solid #dee2e6;
-                    border-radius: 4px;
-                }
-            """)
             btn.clicked.connect(func)
             file_layout.addWidget(btn)
         
@@ -815,64 +3825,10 @@ class PaintX(QMainWindow):
         scroll_area.setWidget(canvas_frame)
         
         self.set_tool("pen")
-        
-        self.update_styles()
+        self.refresh_layers()
         
     def update_styles(self):
-        bg_color = "#2b2b2b" if self.dark_mode else "#f8f9fa"
-        text_color = "#ffffff" if self.dark_mode else "#212529"
-        border_color = "#555555" if self.dark_mode else "#dee2e6"
-        
-        self.setStyleSheet(f"""
-            QMainWindow, QFrame {{
-                background-color: {bg_color};
-            }}
-            QLabel {{
-                color: {text_color};
-                font-size: 11px;
-                padding: 0px;
-                margin: 0px;
-            }}
-            QSlider {{
-                margin: 0px;
-                padding: 0px;
-            }}
-            QSlider::groove:horizontal {{
-                border: 1px solid {border_color};
-                height: 3px;
-                background: {border_color};
-                margin: 0px;
-                border-radius: 1px;
-            }}
-            QSlider::handle:horizontal {{
-                background: {'#ffffff' if self.dark_mode else '#0d6efd'};
-                border: none;
-                width: 10px;
-                margin: -4px 0;
-                border-radius: 5px;
-            }}
-            QPushButton {{
-                background-color: {bg_color};
-                color: {text_color};
-                border: 1px solid {border_color};
-                border-radius: 2px;
-                padding: 1px;
-            }}
-            QPushButton:hover {{
-                background-color: {'#3b3b3b' if self.dark_mode else '#e9ecef'};
-            }}
-            QScrollArea {{
-                border: none;
-            }}
-            QFrame[frameShape="5"] {{  /* Vertical line */
-                background-color: {border_color};
-                max-width: 1px;
-                margin: 2px;
-            }}
-        """)
-        for btn in self.tool_buttons.values():
-            btn.dark_mode = self.dark_mode
-            btn.update_style()
+        self.setStyleSheet(app_stylesheet(self.dark_mode))
             
     def toggle_dark_mode(self):
         self.dark_mode = not self.dark_mode
@@ -907,24 +3863,216 @@ class PaintX(QMainWindow):
         
     def clear_canvas(self):
         self.canvas.clear_canvas()
+        self.refresh_layers()
+        
+    def refresh_layers(self):
+        # The combo lists layers top-most first
+        canvas = self.canvas
+        self.layer_combo.clear()
+        for layer in reversed(canvas.layers):
+            self.layer_combo.addItem(layer.name if layer.visible else f"({layer.name})")
+        self.layer_combo.setCurrentIndex(len(canvas.layers) - 1 -
+                                         canvas.layers.index(canvas.active_layer))
+        self.blend_combo.setCurrentText(canvas.active_layer.blend_mode)
+        self.layer_opacity_spin.blockSignals(True)
+        self.layer_opacity_spin.setValue(round(canvas.active_layer.opacity * 100))
+        self.layer_opacity_spin.blockSignals(False)
+        
+    def select_layer(self, index):
+        self.canvas.end_stroke()
+        self.canvas.active_layer = self.canvas.layers[len(self.canvas.layers) - 1 - index]
+        self.refresh_layers()
+        
+    def add_layer(self):
+        self.canvas.add_layer()
+        self.refresh_layers()
+        
+    def remove_layer(self):
+        self.canvas.remove_layer(self.canvas.active_layer)
+        self.refresh_layers()
+        
+    def toggle_layer_visibility(self):
+        layer = self.canvas.active_layer
+        self.canvas.set_layer_visible(layer, not layer.visible)
+        self.refresh_layers()
+        
+    def change_layer_blend_mode(self, index):
+        self.canvas.set_layer_blend_mode(self.canvas.active_layer, self.blend_combo.itemText(index))
         
+    def change_layer_opacity(self, value):
+        self.canvas.set_layer_opacity(self.canvas.active_layer, value / 100.0)
+        
+    def apply_filter(self):
+        filters = ["Gaussian Blur", "Brightness / Contrast", "Invert Colors"]
+        name, ok = QInputDialog.getItem(self, "Filters", "Filter:", filters, 0, False)
+        if not ok:
+            return
+        if name == "Gaussian Blur":
+            sigma, ok = QInputDialog.getDouble(self, "Gaussian Blur", "Radius:", 2.0, 0.5, 50.0, 1)
+            if ok:
+                self.canvas.blur(sigma)
+        elif name == "Brightness / Contrast":
+            brightness, ok = QInputDialog.getInt(self, "Brightness / Contrast",
+                                                 "Brightness:", 0, -255, 255)
+            if not ok:
+                return
+            contrast, ok = QInputDialog.getDouble(self, "Brightness / Contrast",
+                                                  "Contrast:", 1.0, 0.0, 4.0, 2)
+            if ok:
+                self.canvas.adjust_brightness_contrast(brightness, contrast)
+        else:
+            self.canvas.invert_colors()
+        
+    def toggle_profiling(self):
+        self.canvas.set_profiling(self.canvas.profiler is None)
+        
+    def save_profile(self):
+        if self.canvas.profiler is None:
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Save Frame Timings", "paintx-frames.csv",
+            "CSV Files (*.csv);;JSON Files (*.json)"
+        )
+        if file_path:
+            self.canvas.profiler.dump(file_path)
+            
     def save_image(self):
         file_path, _ = QFileDialog.getSaveFileName(
             self, "Save Image", "",
-            "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg);;All Files (*.*)"
+            "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg);;Paint X Project (*.pxp);;All Files (*.*)"
         )
-        if file_path:
-            self.canvas.save_image(file_path)
+        if not file_path:
+            return
+            
+        if file_path.lower().endswith(".pxp"):
+            self.canvas.save_project(file_path)
+            return
+            
+        if self.export_job is not None:
+            self.export_job.cancel()
+            self.export_job.wait()
+        
+        job = self.canvas.export_image(file_path)
+        if job is None:
+            return
+            
+        progress = QProgressDialog("Saving image...", "Cancel", 0, 100, self)
+        progress.setWindowModality(Qt.NonModal)
+        progress.setMinimumDuration(500)
+        progress.canceled.connect(job.cancel)
+        job.progress.connect(lambda done, total: progress.setValue(int(done * 100 / total)))
+        job.finished.connect(progress.close)
+        job.finished.connect(self.export_finished)
+        
+        self.export_job = job
+        job.start()
+
+    def export_finished(self):
+        # A cancelled job's finished signal can arrive after its replacement started
+        if self.export_job is not None and self.export_job.isFinished():
+            self.export_job = None
             
     def load_image(self):
         file_path, _ = QFileDialog.getOpenFileName(
             self, "Open Image", "",
-            "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg);;All Files (*.*)"
+            "Images and Projects (*.png *.jpg *.jpeg *.pxp);;PNG Files (*.png);;"
+            "JPEG Files (*.jpg *.jpeg);;Paint X Project (*.pxp);;All Files (*.*)"
         )
-        if file_path:
-            image = QPixmap(file_path)
-            if not image.isNull():
-                self.canvas.load_image(image)
+        if not file_path:
+            return
+            
+        if file_path.lower().endswith(".pxp"):
+            try:
+                self.canvas.open_project(file_path)
+            except (OSError, ValueError):
+                pass
+            self.refresh_layers()
+            return
+            
+        if self.import_job is not None:
+            self.import_job.cancel()
+            self.import_job.wait()
+        
+        job = self.canvas.import_image(file_path)
+        if job is None:
+            return
+        self.refresh_layers()
+        progress = QProgressDialog("Opening image...", "Cancel", 0, 100, self)
+        progress.setWindowModality(Qt.NonModal)
+        progress.setMinimumDuration(500)
+        progress.canceled.connect(job.cancel)
+        job.progress.connect(lambda done, total: progress.setValue(int(done * 100 / total)))
+        job.finished.connect(progress.close)
+        job.finished.connect(self.import_finished)
+        
+        self.import_job = job
+        job.start()
+
+    def import_finished(self):
+        # A cancelled job's finished signal can arrive after its replacement started
+        if self.import_job is not None and self.import_job.isFinished():
+            self.import_job = None
+
+    def autosave(self):
+        # Skipped while a stroke is in progress or the last checkpoint is still
+        # being written, so the journal never competes with drawing
+        if self.autosave_job is not None or self.canvas.stroke is not None:
+            return
+        job = self.canvas.autosave(self.journal)
+        if job is None:
+            return
+        job.finished.connect(self.autosave_finished)
+        self.autosave_job = job
+        job.start(QThread.LowPriority)
+
+    def autosave_finished(self):
+        self.autosave_job = None
+        if self.recovered is not None and self.journal.version is not None:
+            # This instance's own journal now holds the recovered drawing
+            self.recovered.delete()
+            self.recovered = None
+
+    def offer_recovery(self):
+        # Newest first; once one is recovered the rest are left for the next start
+        while self.orphans:
+            orphan = self.orphans.pop(0)
+            try:
+                journal = AutosaveJournal.open(orphan.path)
+            except (OSError, ValueError):
+                journal = None
+            if journal is not None and journal.has_content() and QMessageBox.question(
+                    self, "Recover Drawing",
+                    "Paint X did not close properly. Recover the unsaved drawing?") == QMessageBox.Yes:
+                # The old journal stays on disk until the first checkpoint has the drawing
+                self.canvas.recover(journal)
+                journal.close()
+                self.refresh_layers()
+                self.recovered = orphan
+                break
+            if journal is not None:
+                journal.close()
+            orphan.delete()
+        for orphan in self.orphans:
+            orphan.unlock()
+        self.orphans = []
+        self.autosave_timer.start()
+
+    def closeEvent(self, event):
+        # A running save is finished and a running import abandoned before the
+        # journal goes, as Qt aborts if a thread object outlives its window
+        if self.export_job is not None:
+            self.export_job.wait()
+        if self.import_job is not None:
+            self.import_job.cancel()
+            self.import_job.wait()
+        # A clean exit leaves nothing to recover
+        self.autosave_timer.stop()
+        if self.autosave_job is not None:
+            self.autosave_job.wait()
+        self.journal.delete()
+        if self.recovered is not None:
+            self.recovered.delete()
+        super().closeEvent(event)
 
     def update_size_preview(self, size):
         pixmap = QPixmap(self.size_preview.size())
@@ -945,7 +4093,73 @@ class PaintX(QMainWindow):
         painter.end()
         self.size_preview.setPixmap(pixmap)
 
+def run_batch_file(path, output=None):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    if QGuiApplication.instance() is None:
+        QGuiApplication([])
+    document = Document()
+    with open(path, encoding="utf-8") as handle:
+        for line_number, line in enumerate(handle, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                document.apply_command(json.loads(line))
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                # Malformed fields surface as any of these; all of them are the command's fault
+                raise ValueError(f"{path}:{line_number}: {error}") from error
+    if output and not document.save_image(output):
+        raise ValueError(f"{path}: could not export {output} (empty canvas or unwritable path)")
+    document.clear_canvas()
+
+def batch_worker(path, output):
+    try:
+        run_batch_file(path, output)
+    except (OSError, ValueError) as error:
+        return str(error)
+    return None
+
+def batch_main(argv):
+    import argparse
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    
+    parser = argparse.ArgumentParser(
+        prog="paint_x.py", description="Replay Paint X command files without opening a window.")
+    parser.add_argument("--batch", nargs="+", metavar="FILE", required=True,
+                        help="JSON-lines command files")
+    parser.add_argument("-o", "--output",
+                        help="image exported after each file (a directory for several files)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes for several files")
+    args = parser.parse_args(argv)
+    
+    if args.output and len(args.batch) > 1:
+        os.makedirs(args.output, exist_ok=True)
+    outputs = []
+    for path in args.batch:
+        if args.output and len(args.batch) > 1:
+            name = os.path.splitext(os.path.basename(path))[0] + ".png"
+            outputs.append(os.path.join(args.output, name))
+        else:
+            outputs.append(args.output)
+    
+    if args.jobs > 1 and len(args.batch) > 1:
+        # Each worker gets a fresh interpreter and its own offscreen Qt instance
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.jobs, mp_context=context) as pool:
+            errors = list(pool.map(batch_worker, args.batch, outputs))
+    else:
+        errors = [batch_worker(path, output) for path, output in zip(args.batch, outputs)]
+    
+    for error in errors:
+        if error:
+            print(error, file=sys.stderr)
+    return 1 if any(errors) else 0
+
 if __name__ == "__main__":
+    if "--batch" in sys.argv[1:]:
+        sys.exit(batch_main(sys.argv[1:]))
     app = QApplication(sys.argv)
     app.setStyle("Fusion")
     window = PaintX()
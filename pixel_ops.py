@@ -0,0 +1,255 @@
+import math
+import numpy as np
+from PySide6.QtGui import QImage
+
+
+def image_array(image):
+    # Writable (h, w, 4) view onto a premultiplied ARGB32 QImage, valid only while
+    # the image is alive; on little-endian machines the channel order is B, G, R, A
+    if image.format() != QImage.Format_ARGB32_Premultiplied:
+        raise ValueError("image must be Format_ARGB32_Premultiplied")
+    return np.ndarray((image.height(), image.width(), 4), dtype=np.uint8,
+                      buffer=image.bits(), strides=(image.bytesPerLine(), 4, 1))
+
+def premultiplied_bgra(color, opacity=1.0):
+    alpha = color.alphaF() * opacity
+    return np.array([color.blue() * alpha, color.green() * alpha,
+                     color.red() * alpha, 255 * alpha], dtype=np.float32)
+
+def invert(pixels):
+    # Premultiplied channels invert against alpha, which leaves transparency alone
+    pixels[..., :3] = pixels[..., 3:4] - pixels[..., :3]
+
+def brightness_contrast(pixels, brightness=0, contrast=1.0):
+    alpha = pixels[..., 3:4].astype(np.float32)
+    visible = alpha > 0
+    color = np.divide(pixels[..., :3] * np.float32(255), alpha,
+                      out=np.zeros(pixels.shape[:2] + (3,), np.float32), where=visible)
+    color = (color - 128) * contrast + 128 + brightness
+    np.clip(color, 0, 255, out=color)
+    pixels[..., :3] = np.rint(color * alpha / 255)
+
+def gaussian_kernel(sigma, max_radius):
+    radius = min(max_radius, max(1, math.ceil(sigma * 3)))
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-(x * x) / (2 * sigma * sigma))
+    return kernel / kernel.sum()
+
+def convolve_separable(padded, kernel):
+    radius = len(kernel) // 2
+    height = padded.shape[0] - 2 * radius
+    width = padded.shape[1] - 2 * radius
+    rows = np.zeros((padded.shape[0], width, 4), np.float32)
+    for i, weight in enumerate(kernel):
+        rows += weight * padded[:, i:i + width]
+    out = np.zeros((height, width, 4), np.float32)
+    for i, weight in enumerate(kernel):
+        out += weight * rows[i:i + height]
+    return out
+
+def gather_padded(arrays, key, tile_size, pad):
+    # Assemble the bordered tile plus `pad` pixels of surrounding interiors;
+    # tiles missing from `arrays` read as transparent
+    tx, ty = key
+    size = tile_size + 2 + 2 * pad
+    left = tx * tile_size - 1 - pad
+    top = ty * tile_size - 1 - pad
+    padded = np.zeros((size, size, 4), np.float32)
+    for ny in (ty - 1, ty, ty + 1):
+        for nx in (tx - 1, tx, tx + 1):
+            pixels = arrays.get((nx, ny))
+            if pixels is None:
+                continue
+            x0 = max(nx * tile_size, left)
+            x1 = min((nx + 1) * tile_size, left + size)
+            y0 = max(ny * tile_size, top)
+            y1 = min((ny + 1) * tile_size, top + size)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            padded[y0 - top:y1 - top, x0 - left:x1 - left] = pixels[
+                y0 - ny * tile_size + 1:y1 - ny * tile_size + 1,
+                x0 - nx * tile_size + 1:x1 - nx * tile_size + 1]
+    return padded
+
+def blur_tile(arrays, key, tile_size, kernel):
+    padded = gather_padded(arrays, key, tile_size, len(kernel) // 2)
+    return np.rint(convolve_separable(padded, kernel)).astype(np.uint8)
+
+def sync_borders(arrays, tile_size):
+    # Copy each interior's edge pixels into the one-pixel border of its neighbours
+    ts = tile_size
+    spans = {-1: (slice(0, 1), slice(ts, ts + 1)),
+             0: (slice(1, ts + 1), slice(1, ts + 1)),
+             1: (slice(ts + 1, ts + 2), slice(1, 2))}
+    for (tx, ty), pixels in arrays.items():
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dx == 0 and dy == 0:
+                    continue
+                source = arrays.get((tx + dx, ty + dy))
+                if source is None:
+                    continue
+                dst_y, src_y = spans[dy]
+                dst_x, src_x = spans[dx]
+                pixels[dst_y, dst_x] = source[src_y, src_x]
+
+def argb_bgra(argb):
+    # One premultiplied ARGB32 value as the B, G, R, A bytes a tile array holds
+    return np.array([argb], np.uint32).view(np.uint8)
+
+def flood_fill(load, key, x, y, tile_size, bounds, tolerance=32):
+    # Scanline fill over tile interiors, limited to the image pixels in
+    # bounds = (left, top, right, bottom), right and bottom exclusive. `load(key)`
+    # returns a tile array or the premultiplied ARGB value of a uniform tile;
+    # returns {key: filled mask}, with True for a tile filled whole. Uniform tiles
+    # wholly inside the bounds never get a pixel array or a mask of their own.
+    ts = tile_size
+    min_x, min_y, max_x, max_y = bounds
+    masks = {}
+    filled = {}
+
+    def clip(key):
+        # The tile's interior rows and columns inside the bounds, or None
+        x0, y0 = key[0] * ts, key[1] * ts
+        cols = (max(min_x - x0, 0), min(max_x - x0, ts))
+        rows = (max(min_y - y0, 0), min(max_y - y0, ts))
+        if cols[0] >= cols[1] or rows[0] >= rows[1]:
+            return None
+        return rows, cols
+
+    def state(key):
+        if key not in masks:
+            inside = clip(key)
+            pixels = load(key) if inside is not None else None
+            if pixels is None:
+                masks[key] = None
+                return None, None
+            whole = inside == ((0, ts), (0, ts))
+            if isinstance(pixels, int):
+                difference = np.abs(argb_bgra(pixels).astype(np.int16) - target).max()
+                if difference > tolerance:
+                    masks[key] = None
+                    return None, None
+                if whole:
+                    masks[key] = True
+                    filled[key] = False
+                    return True, False
+                mask = np.ones((ts, ts), bool)
+            else:
+                interior = pixels[1:ts + 1, 1:ts + 1].astype(np.int16)
+                mask = np.abs(interior - target).max(axis=2) <= tolerance
+            if not whole:
+                (r0, r1), (c0, c1) = inside
+                clipped = np.zeros((ts, ts), bool)
+                clipped[r0:r1, c0:c1] = mask[r0:r1, c0:c1]
+                mask = clipped
+            masks[key] = mask
+            filled[key] = np.zeros((ts, ts), bool)
+        return masks[key], filled.get(key)
+
+    if not (min_x <= key[0] * ts + x < max_x and min_y <= key[1] * ts + y < max_y):
+        return {}
+    seed = load(key)
+    if isinstance(seed, int):
+        target = argb_bgra(seed).astype(np.int16)
+    else:
+        target = seed[y + 1, x + 1].astype(np.int16)
+    stack = [(key, y, x, x + 1)]
+    while stack:
+        key, row, left, right = stack.pop()
+        mask, done = state(key)
+        if mask is None or done is True:
+            continue
+        tx, ty = key
+        if mask is True:
+            # A matching uniform tile fills whole the first time a span reaches it;
+            # a row of None stands for the whole facing column of a side neighbour
+            filled[key] = True
+            stack.append(((tx, ty - 1), ts - 1, 0, ts))
+            stack.append(((tx, ty + 1), 0, 0, ts))
+            stack.append(((tx - 1, ty), None, ts - 1, ts))
+            stack.append(((tx + 1, ty), None, 0, 1))
+            continue
+        if row is None:
+            stack.extend((key, row, left, right) for row in range(ts))
+            continue
+        open_row = mask[row] & ~done[row]
+        candidates = np.flatnonzero(open_row[left:right])
+        if len(candidates) == 0:
+            continue
+        starts = candidates[np.concatenate(([True], np.diff(candidates) > 1))] + left
+        for start in starts:
+            if done[row, start]:
+                continue
+            blocked = np.flatnonzero(~open_row[:start])
+            span_left = blocked[-1] + 1 if len(blocked) else 0
+            blocked = np.flatnonzero(~open_row[start:])
+            span_right = start + blocked[0] if len(blocked) else ts
+            done[row, span_left:span_right] = True
+            open_row = mask[row] & ~done[row]
+            if row > 0:
+                stack.append((key, row - 1, span_left, span_right))
+            else:
+                stack.append(((tx, ty - 1), ts - 1, span_left, span_right))
+            if row < ts - 1:
+                stack.append((key, row + 1, span_left, span_right))
+            else:
+                stack.append(((tx, ty + 1), 0, span_left, span_right))
+            if span_left == 0:
+                stack.append(((tx - 1, ty), row, ts - 1, ts))
+            if span_right == ts:
+                stack.append(((tx + 1, ty), row, 0, 1))
+    return {key: done for key, done in filled.items() if done is True or
+            (done is not False and done.any())}
+
+def stamp_max(pixels, dab, x, y):
+    # Merge a dab at (x, y) keeping the stronger coverage per pixel, so dabs of
+    # one colour never build up past their own alpha however much they overlap
+    height, width = dab.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + width, pixels.shape[1]), min(y + height, pixels.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    region = pixels[y0:y1, x0:x1]
+    np.maximum(region, dab[y0 - y:y1 - y, x0 - x:x1 - x], out=region)
+
+def fill_mask(pixels, mask, color):
+    # Source-over a premultiplied colour onto the masked interior pixels;
+    # a mask of True fills the whole interior
+    interior = pixels[1:-1, 1:-1]
+    if mask is True:
+        interior[...] = np.rint(color + interior * (1 - color[3] / 255))
+        return
+    dst = interior[mask].astype(np.float32)
+    interior[mask] = np.rint(color + dst * (1 - color[3] / 255))
+
+def fill_solid(argb, color):
+    # fill_mask for a uniform tile, on its one ARGB value
+    pixel = color + argb_bgra(argb) * (1 - color[3] / 255)
+    return int(np.rint(pixel).astype(np.uint8).view(np.uint32)[0])
+
+def compact_form(pixels, max_colors=256):
+    # ("solid", argb) for a flat tile, ("palette", (palette, indices, run lengths))
+    # for run-length encodable low-colour content, None when neither pays off
+    flat = np.ascontiguousarray(pixels).view(np.uint32).reshape(-1)
+    starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    if len(starts) == 0:
+        return "solid", int(flat[0])
+    if (len(starts) + 1) * 5 > flat.nbytes // 8:
+        return None
+    starts = np.concatenate(([0], starts))
+    palette, indices = np.unique(flat[starts], return_inverse=True)
+    if len(palette) > max_colors:
+        return None
+    lengths = np.diff(np.append(starts, len(flat))).astype(np.uint32)
+    return "palette", (palette, indices.astype(np.uint8), lengths)
+
+def palette_image(palette, indices, lengths, width, height):
+    flat = np.repeat(palette[indices], lengths)
+    return array_image(flat.view(np.uint8).reshape(height, width, 4))
+
+def array_image(pixels):
+    height, width = pixels.shape[:2]
+    pixels = np.ascontiguousarray(pixels)
+    return QImage(pixels.data, width, height, width * 4,
+                  QImage.Format_ARGB32_Premultiplied).copy()
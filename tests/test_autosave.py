@@ -0,0 +1,102 @@
+import os
+
+import pytest
+from PySide6.QtCore import QPointF
+from PySide6.QtGui import QColor, QFont
+
+import paint_x
+
+
+def pixel(document, x, y):
+    key, local = document.point_to_tile(QPointF(x, y))
+    image = document.get_tile_image(key)
+    return None if image is None else image.pixel(int(local.x()) + 1, int(local.y()) + 1)
+
+
+def draw(document, start, end, color="#ff0000"):
+    document.apply_command({"op": "stroke", "tool": "pen", "size": 6, "color": color,
+                            "points": [list(start), list(end)]})
+
+
+def checkpoint(document, journal):
+    job = document.autosave(journal)
+    job.run()
+    assert job.ok
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = paint_x.AutosaveJournal.claim(str(tmp_path))
+    yield journal
+    journal.delete()
+
+
+@pytest.fixture
+def recovered(app):
+    documents = []
+
+    def recover(path):
+        journal = paint_x.AutosaveJournal.open(path)
+        document = paint_x.Document()
+        document.recover(journal)
+        journal.close()
+        documents.append(document)
+        return document
+
+    yield recover
+    for document in documents:
+        document.clear_canvas()
+
+
+def test_checkpoints_append_only_what_changed(document, journal, recovered):
+    draw(document, (10, 10), (2000, 10))
+    checkpoint(document, journal)
+    full_size = os.path.getsize(journal.path)
+    assert document.autosave(journal) is None
+
+    draw(document, (10, 100), (60, 100), "#0000ff")
+    document.add_text("hello", QPointF(40, 40), QFont("Arial"), QColor("#00ff00"))
+    checkpoint(document, journal)
+    assert os.path.getsize(journal.path) - full_size < full_size / 2
+
+    copy = recovered(journal.path)
+    assert pixel(copy, 1500, 10) == QColor("#ff0000").rgba()
+    assert pixel(copy, 30, 100) == QColor("#0000ff").rgba()
+    assert [item.text for item in copy.all_text_items()] == ["hello"]
+
+
+def test_recovery_stops_at_a_torn_checkpoint(document, journal, recovered):
+    draw(document, (10, 10), (300, 10))
+    checkpoint(document, journal)
+    draw(document, (10, 100), (300, 100), "#0000ff")
+    checkpoint(document, journal)
+    # The app died while the second checkpoint was being written
+    size = os.path.getsize(journal.path)
+    with open(journal.path, "r+b") as handle:
+        handle.truncate(size - 20)
+
+    copy = recovered(journal.path)
+    assert pixel(copy, 100, 10) == QColor("#ff0000").rgba()
+    assert pixel(copy, 100, 100) == 0
+
+
+def test_compaction_drops_overwritten_tiles(document, journal, recovered):
+    colors = ["#ff0000", "#00ff00", "#0000ff", "#ffff00"]
+    for color in colors:
+        draw(document, (10, 10), (1000, 300), color)
+        checkpoint(document, journal)
+    before = journal.file_bytes
+    assert before > 2 * journal.live_bytes
+
+    journal.compact()
+    assert journal.compactions == 1
+    assert journal.file_bytes < before / 2
+    assert os.path.getsize(journal.path) == journal.file_bytes
+
+    # Later checkpoints append to the compacted file as usual
+    draw(document, (10, 500), (300, 500), "#00ffff")
+    checkpoint(document, journal)
+    copy = recovered(journal.path)
+    assert copy.stored_keys() == document.stored_keys()
+    for key in document.stored_keys():
+        assert copy.get_stored_image(key) == document.get_stored_image(key)
@@ -0,0 +1,37 @@
+import pytest
+
+import paint_x
+
+
+def run_lines(tmp_path, *lines):
+    path = tmp_path / "commands.jsonl"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    paint_x.run_batch_file(str(path))
+    return str(path)
+
+
+def test_unknown_tool_reports_its_line(app, tmp_path):
+    with pytest.raises(ValueError, match=r"commands\.jsonl:2: unknown tool 'pne'"):
+        run_lines(tmp_path, '{"op": "stroke", "points": [[1, 1], [50, 50]]}',
+                  '{"op": "set", "tool": "pne"}')
+
+
+@pytest.mark.parametrize("sigma", [0, -1.5])
+def test_non_positive_blur_sigma_reports_its_line(app, tmp_path, sigma):
+    with pytest.raises(ValueError, match=r"commands\.jsonl:2: blur sigma must be positive"):
+        run_lines(tmp_path, '{"op": "stroke", "points": [[1, 1], [50, 50]]}',
+                  f'{{"op": "blur", "sigma": {sigma}}}')
+
+
+@pytest.mark.parametrize("setting, message", [
+    ('"size": "big"', "size must be a number at least 1, got 'big'"),
+    ('"size": 0', "size must be a number at least 1, got 0"),
+    ('"opacity": 1.5', "opacity must be a number from 0 to 1, got 1.5"),
+    ('"hardness": true', "hardness must be a number from 0 to 1, got True"),
+    ('"color": "blurple"', "invalid color 'blurple'"),
+])
+def test_bad_settings_report_their_own_line(app, tmp_path, setting, message):
+    with pytest.raises(ValueError) as error:
+        run_lines(tmp_path, f'{{"op": "set", {setting}}}',
+                  '{"op": "stroke", "points": [[1, 1], [50, 50]]}')
+    assert str(error.value).endswith(f"commands.jsonl:1: {message}")
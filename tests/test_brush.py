@@ -0,0 +1,13 @@
+import pytest
+from PySide6.QtGui import QColor
+
+
+@pytest.mark.parametrize("opacity", [1.0, 0.3, 0.1])
+def test_stroke_centre_alpha_matches_opacity(document, opacity):
+    # Dabs overlap at 0.1x the brush size; they must not add up past the opacity
+    document.apply_command({"op": "stroke", "tool": "brush", "size": 20, "color": "#000000",
+                            "opacity": opacity,
+                            "points": [[20 + i * 5, 100] for i in range(40)]})
+    image = document.get_tile_image((0, 0))
+    alpha = QColor.fromRgba(image.pixel(101, 101)).alpha()
+    assert abs(alpha - opacity * 255) <= 3
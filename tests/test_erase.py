@@ -0,0 +1,37 @@
+from PySide6.QtCore import QPointF
+from PySide6.QtGui import QColor, QImage
+
+
+def pixel(document, x, y):
+    key, local = document.point_to_tile(QPointF(x, y))
+    return document.get_tile_image(key).pixel(int(local.x()) + 1, int(local.y()) + 1)
+
+
+def erase(document, start, end):
+    document.apply_command({"op": "stroke", "tool": "eraser", "size": 10,
+                            "points": [list(start), list(end)]})
+
+
+def test_eraser_clears_an_imported_opaque_image(document, tmp_path):
+    image = QImage(800, 800, QImage.Format_RGB32)
+    image.fill(QColor("white"))
+    for x in range(800):
+        # Noisy enough that the tiles stay full pixmaps
+        image.setPixel(x, x, 0xff000000 | (x * 97 % 0xffffff))
+    path = str(tmp_path / "opaque.png")
+    assert image.save(path)
+    job = document.import_image(path)
+    job.run()
+    assert document.tile_memory((1, 1))["form"] == "pixmap"
+    erase(document, (300, 400), (450, 400))
+    assert pixel(document, 350, 400) == 0
+
+
+def test_eraser_clears_a_fill(document):
+    document.apply_command({"op": "shape", "shape": "rectangle",
+                            "start": [10, 10], "end": [600, 600]})
+    document.apply_command({"op": "fill", "point": [300, 300], "color": "#f0c040"})
+    # The fill writes the inside of the rectangle as solid tiles
+    assert document.tile_memory((1, 1))["form"] == "solid"
+    erase(document, (300, 400), (450, 400))
+    assert pixel(document, 350, 400) == 0
@@ -0,0 +1,29 @@
+import os
+
+from PySide6.QtCore import QPointF
+from PySide6.QtGui import QImage
+
+
+def draw_rows(document, rows=3):
+    document.tool = "pen"
+    document.draw_line_between_points(QPointF(10, 10), QPointF(10, rows * 256 - 10))
+
+
+def test_export_writes_png(document, tmp_path):
+    draw_rows(document)
+    path = str(tmp_path / "out.png")
+    assert document.save_image(path)
+    assert QImage(path).height() == 3 * 256
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_cancelled_export_keeps_existing_file(document, tmp_path):
+    draw_rows(document)
+    path = tmp_path / "out.png"
+    path.write_bytes(b"original")
+    job = document.export_image(str(path))
+    job.progress.connect(lambda done, total: job.cancel())
+    job.run()
+    assert not job.ok
+    assert path.read_bytes() == b"original"
+    assert not os.path.exists(str(path) + ".tmp")
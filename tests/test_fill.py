@@ -0,0 +1,41 @@
+from PySide6.QtCore import QPointF
+
+
+def test_fill_of_empty_space_stays_within_drawing_and_solid(document):
+    document.apply_command({"op": "stroke", "tool": "pen", "points": [[10, 10], [20, 20]]})
+    document.apply_command({"op": "stroke", "tool": "pen", "points": [[2600, 2600], [2610, 2610]]})
+    document.flood_fill(QPointF(1300, 1300))
+    keys = document.all_tile_keys()
+    assert keys == {(tx, ty) for tx in range(11) for ty in range(11)}
+    # Tiles away from the strokes are filled whole and never expand to pixmaps
+    assert document.tile_memory((5, 5)) == {"form": "solid", "bytes": 256}
+    assert document.get_tile_image((5, 5)).pixel(1, 1) == 0xff000000
+    document.undo()
+    assert len(document.all_tile_keys()) == 2
+
+
+def test_headless_fill_stops_at_the_export_extent(document):
+    document.flood_fill(QPointF(100, 100))
+    assert not document.all_tile_keys()
+    document.apply_command({"op": "stroke", "tool": "pen", "points": [[10, 10], [20, 20]]})
+    # Outside the drawn tiles there is nothing to fill
+    document.flood_fill(QPointF(600, 600))
+    assert document.all_tile_keys() == {(0, 0)}
+
+
+def test_canvas_fill_stops_at_the_viewport(app):
+    import paint_x
+    canvas = paint_x.Canvas()
+    canvas.resize(300, 200)
+    canvas.offset = QPointF(-20, -10)
+    canvas.flood_fill(QPointF(100, 100))
+    # The view shows image pixels 20..319 by 10..209
+    filled = canvas.get_tile_image((1, 0))
+    assert filled.pixel(319 - 256 + 1, 209 + 1) == 0xff000000
+    assert filled.pixel(320 - 256 + 1, 100) == 0
+    assert filled.pixel(100, 210 + 1) == 0
+    corner = canvas.get_tile_image((0, 0))
+    assert corner.pixel(20 + 1, 10 + 1) == 0xff000000
+    assert corner.pixel(19 + 1, 100) == 0
+    assert canvas.all_tile_keys() == {(0, 0), (1, 0)}
+    canvas.clear_canvas()
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from PySide6.QtCore import QPointF
+from PySide6.QtGui import QColor, QFont
+
+import paint_x
+
+
+def pixel(document, x, y):
+    key, local = document.point_to_tile(QPointF(x, y))
+    image = document.get_tile_image(key)
+    return None if image is None else image.pixel(int(local.x()) + 1, int(local.y()) + 1)
+
+
+def draw(document, start, end, color="#ff0000"):
+    document.apply_command({"op": "stroke", "tool": "pen", "size": 6, "color": color,
+                            "points": [list(start), list(end)]})
+
+
+@pytest.fixture
+def reopened(app):
+    documents = []
+
+    def reopen(path):
+        document = paint_x.Document()
+        document.open_project(path)
+        documents.append(document)
+        return document
+
+    yield reopen
+    for document in documents:
+        document.clear_canvas()
+
+
+def test_full_save_round_trip(document, reopened, tmp_path):
+    path = str(tmp_path / "drawing.pxp")
+    draw(document, (10, 10), (600, 300))
+    layer = document.add_layer("Ink")
+    document.set_layer_opacity(layer, 0.5)
+    draw(document, (100, 500), (700, 500), "#0000ff")
+    document.add_text("hello", QPointF(40, 40), QFont("Arial"), QColor("#00ff00"))
+    document.save_project(path)
+
+    copy = reopened(path)
+    assert [(l.name, l.opacity) for l in copy.layers] == [("Background", 1.0), ("Ink", 0.5)]
+    assert copy.stored_keys() == document.stored_keys()
+    for key in document.stored_keys():
+        assert copy.get_stored_image(key) == document.get_stored_image(key)
+    assert [item.text for item in copy.all_text_items()] == ["hello"]
+
+
+def test_incremental_save_appends_only_changed_tiles(document, reopened, tmp_path):
+    path = str(tmp_path / "drawing.pxp")
+    draw(document, (10, 10), (2000, 10))
+    document.save_project(path)
+    full_size = os.path.getsize(path)
+
+    draw(document, (10, 100), (60, 100), "#0000ff")
+    document.save_project(path)
+    # One tile and a new index are appended; the untouched tiles are not rewritten
+    assert os.path.getsize(path) - full_size < full_size / 2
+
+    copy = reopened(path)
+    assert pixel(copy, 30, 100) == QColor("#0000ff").rgba()
+    assert pixel(copy, 1500, 10) == QColor("#ff0000").rgba()
+
+
+def test_torn_tail_opens_as_the_last_complete_save(document, reopened, tmp_path):
+    path = str(tmp_path / "drawing.pxp")
+    draw(document, (10, 10), (300, 10))
+    document.save_project(path)
+    draw(document, (10, 100), (300, 100), "#0000ff")
+    document.save_project(path)
+    # A save cut short: the second save's index and trailer are only half written
+    size = os.path.getsize(path)
+    with open(path, "r+b") as handle:
+        handle.truncate(size - 20)
+
+    copy = reopened(path)
+    assert pixel(copy, 100, 10) == QColor("#ff0000").rgba()
+    assert pixel(copy, 100, 100) == 0
+
+
+def test_opening_a_non_project_raises(app, tmp_path):
+    path = tmp_path / "junk.pxp"
+    path.write_bytes(b"not a project at all, just some bytes")
+    with pytest.raises(ValueError):
+        paint_x.ProjectFile.open(str(path))
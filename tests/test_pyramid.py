@@ -0,0 +1,19 @@
+import time
+
+from PySide6.QtCore import QPointF
+
+
+def test_cold_pyramid_builds_within_the_deadline(document):
+    document.tool = "pen"
+    document.draw_line_between_points(QPointF(0, 0), QPointF(2000, 2000))
+    pyramid = document.pyramid
+    assert pyramid.get_within(3, 0, 0, time.perf_counter() - 1) is None
+    assert pyramid.placeholder(3, 0, 0) == (None, None)
+    # Work left over from one frame carries on in the next until the tile is ready
+    frames = 0
+    while pyramid.get_within(3, 0, 0, time.perf_counter() + 0.001) is None:
+        frames += 1
+        assert frames < 100
+    assert pyramid.is_fresh(3, 0, 0)
+    pixmap, source = pyramid.placeholder(2, 1, 1)
+    assert pixmap is not None and source.width() == document.tile_size
@@ -0,0 +1,48 @@
+from PySide6.QtGui import QColor, QImage
+
+
+def draw(document, start, end, color):
+    document.apply_command({"op": "stroke", "tool": "pen", "size": 6, "color": color,
+                            "points": [list(start), list(end)]})
+
+
+def evict_all(document):
+    for key in list(document.tiles.keys()):
+        document.tiles.evict(key)
+
+
+def test_export_keeps_the_drawing_from_when_it_started(document, tmp_path):
+    draw(document, (10, 10), (600, 10), "#ff0000")
+    path = str(tmp_path / "out.png")
+    job = document.export_image(path)
+    # Drawing goes on over the same tiles before the worker reads them
+    draw(document, (10, 10), (600, 10), "#0000ff")
+    draw(document, (10, 300), (600, 300), "#0000ff")
+    job.run()
+    assert job.ok
+    image = QImage(path)
+    assert image.height() == 256
+    assert image.pixelColor(100, 10) == QColor("#ff0000")
+
+
+def test_snapshot_reads_evicted_tiles_that_are_drawn_over_again(document):
+    draw(document, (10, 10), (600, 10), "#ff0000")
+    evict_all(document)
+    assert document.tile_store.keys()
+    snapshot = document.snapshot()
+    before = snapshot.image((0, 0))
+    # The tiles are paged back in, redrawn and spilled to the scratch file again
+    draw(document, (10, 10), (600, 10), "#0000ff")
+    evict_all(document)
+    assert snapshot.image((0, 0)) == before
+    assert before.pixelColor(101, 11) == QColor("#ff0000")
+    assert document.get_tile_image((0, 0)).pixelColor(101, 11) == QColor("#0000ff")
+
+
+def test_snapshot_of_resident_tiles_is_copy_on_write(document):
+    draw(document, (10, 10), (600, 10), "#ff0000")
+    snapshot = document.snapshot()
+    before = QImage(snapshot.image((1, 0)))
+    draw(document, (10, 10), (600, 10), "#0000ff")
+    assert snapshot.image((1, 0)) == before
+    assert document.get_tile_image((1, 0)) != before
@@ -0,0 +1,46 @@
+import os
+
+from PySide6.QtCore import QPointF
+
+import paint_x
+
+
+def snapshot(document):
+    return {key: document.get_stored_image(key) for key in document.stored_keys()}
+
+
+def test_undo_and_redo_across_records_spilled_to_disk(document):
+    # Every record is over a one byte budget, so each one is spilled to disk
+    document.history = paint_x.UndoHistory(max_bytes=1)
+    states = [snapshot(document)]
+    for i in range(6):
+        document.apply_command({"op": "stroke", "tool": "pen", "size": 8,
+                                "color": f"#{40 * i:02x}3080",
+                                "points": [[10, 20 + 40 * i], [700, 60 + 40 * i]]})
+        states.append(snapshot(document))
+    assert document.history.disk_records == 6
+
+    for state in reversed(states[:-1]):
+        assert document.undo()
+        assert snapshot(document) == state
+    assert not document.undo()
+    for state in states[1:]:
+        assert document.redo()
+        assert snapshot(document) == state
+    assert not document.redo()
+
+
+def test_compaction_keeps_spilled_records_readable(app):
+    history = paint_x.UndoHistory(max_bytes=0)
+    blobs = [(os.urandom(1024 * 1024), 258, 258) for _ in range(8)]
+    for i, blob in enumerate(blobs):
+        history.push({(0, i, 0): blob})
+    assert history.disk_records == 8
+    # Undoing the newest records leaves most of the file dead, which compacts it
+    for i in reversed(range(3, 8)):
+        assert history.pop_undo() == {(0, i, 0): blobs[i]}
+    assert history.file_bytes == history.live_bytes == 3 * 1024 * 1024
+    for i in reversed(range(3)):
+        assert history.pop_undo() == {(0, i, 0): blobs[i]}
+    assert history.pop_undo() is None
+    assert history.file_bytes == 0